@@ -1,14 +1,168 @@
-import os, re, random, math, httpx
-from fastapi import FastAPI
+import os, io, re, json, html, random, math, time, bisect, asyncio, logging, tempfile, cProfile, pstats, httpx, orjson
+import numpy as np
+import xml.etree.ElementTree as ET
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse
-from pydantic import BaseModel
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    global POOL
+    POOL = ProcessPoolExecutor(BATCH_WORKERS)
+    await ROUTER.open()
+    yield
+    await ROUTER.close()
+    POOL.shutdown(cancel_futures=True)
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 
+log = logging.getLogger("symphony")
+
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _labels(names, values):
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}" if names else ""
+
+class Histogram:
+    """Prometheus-style histogram; one series per tuple of label values."""
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames, self.buckets = name, help, labelnames, buckets
+        self.series = {}
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for le, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels((*self.labelnames, 'le'), (*labels, le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class CounterMetric:
+    def __init__(self, name, help, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.series = {}
+        METRICS.append(self)
+
+    def inc(self, *labels, value=1):
+        self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"] + [f"{self.name}{_labels(self.labelnames, labels)} {v}" for labels, v in self.series.items()]
+
+METRICS = []
+STAGE_SECONDS = Histogram("symphony_stage_seconds", "Time spent in each local analysis stage.", ("stage",))
+PROVIDER_SECONDS = Histogram("symphony_provider_seconds", "LLM provider call latency by outcome.", ("provider", "outcome"))
+PROVIDER_SKIPPED = CounterMetric("symphony_provider_skipped_total", "Provider calls skipped because the circuit breaker was open.", ("provider",))
+SOLVE_TOTAL = CounterMetric("symphony_solve_total", "Answered analysis requests by the path that produced the answer.", ("endpoint", "source"))
+SHED_TOTAL = CounterMetric("symphony_shed_total", "LLM calls not made, by the reason the request was answered locally.", ("endpoint", "reason"))
+REQUEST_SECONDS = Histogram("symphony_request_seconds", "HTTP request latency by route.", ("route", "method"))
+
+class StageClock:
+    """Records the time since the previous lap under a stage label."""
+    __slots__ = ("t",)
+
+    def __init__(self):
+        self.t = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        STAGE_SECONDS.observe(now - self.t, stage)
+        self.t = now
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    caches = {"llm": LLM_CACHE, "local": LOCAL_CACHE, "analysis": ANALYSIS_CACHE}
+    for field_name in ("hits", "misses", "evictions", "coalesced"):
+        lines.append(f"# TYPE symphony_cache_{field_name}_total counter")
+        lines += [f'symphony_cache_{field_name}_total{{cache="{n}"}} {getattr(c, field_name)}' for n, c in caches.items()]
+    lines += ["# TYPE symphony_llm_inflight gauge", f"symphony_llm_inflight {ADMISSION.inflight}",
+              "# TYPE symphony_llm_queued gauge", f"symphony_llm_queued {ADMISSION.waiting}",
+              "# TYPE symphony_llm_latency_seconds gauge", f"symphony_llm_latency_seconds {ADMISSION.latency:.4f}"]
+    return "\n".join(lines) + "\n"
+
+PROFILING = os.environ.get("PROFILING", "").lower() in ("1", "true", "yes")
+PROFILES = OrderedDict()
+TRACING = False  # a cProfile trace is running
+
+async def profiled(call_next, request):
+    """Run one request under pyinstrument if installed; its async mode attributes
+    samples to this request's task only. The cProfile fallback is a process-wide
+    trace: it counts every coroutine the loop ran meanwhile, so use it on an
+    otherwise idle server. Only one cProfile trace runs at a time; requests that
+    arrive during one are served unprofiled."""
+    global TRACING
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        Profiler = None
+    if Profiler is not None:
+        profiler = Profiler(async_mode="enabled")
+        with profiler:
+            response = await call_next(request)
+        report = profiler.output_text()
+    elif TRACING:
+        return await call_next(request)
+    else:
+        profiler = cProfile.Profile()
+        TRACING = True
+        profiler.enable()
+        try:
+            response = await call_next(request)
+        finally:
+            profiler.disable()
+            TRACING = False
+        out = io.StringIO()
+        out.write("cProfile: process-wide trace, includes work for any request served concurrently.\n")
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(40)
+        report = out.getvalue()
+    profile_id = f"{time.time_ns():x}"
+    PROFILES[profile_id] = report
+    while len(PROFILES) > 32:
+        PROFILES.popitem(last=False)
+    response.headers["X-Profile-Id"] = profile_id
+    return response
+
+@app.middleware("http")
+async def observe_requests(request, call_next):
+    start = time.perf_counter()
+    request.scope["received"] = time.monotonic()
+    if PROFILING and request.headers.get("x-profile"):
+        response = await profiled(call_next, request)
+    else:
+        response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(time.perf_counter() - start, route.path if route else "unmatched", request.method)
+    return response
+
 NOTES = {"C": 261.63, "C#": 277.18, "D": 293.66, "D#": 311.13, "E": 329.63, "F": 349.23, "F#": 369.99, "G": 392.00, "G#": 415.30, "A": 440.00, "A#": 466.16, "B": 493.88}
 NOTE_LIST = list(NOTES.keys())
+NOTE_INDEX = {n: i for i, n in enumerate(NOTE_LIST)}
+# Notes are MIDI numbers (60 = C4); NOTES is octave 4 of this table.
+DEFAULT_OCTAVE = 4
+MIDI_FREQS = np.round(440.0 * 2 ** ((np.arange(128) - 69) / 12), 2)
+MIDI_NAMES = [f"{NOTE_LIST[m % 12]}{m // 12 - 1}" for m in range(128)]
+CONSONANT_STEPS = {0, 3, 4, 5, 7, 8, 9}
 INTERVALS = {0: "unison", 1: "minor 2nd", 2: "major 2nd", 3: "minor 3rd", 4: "major 3rd", 5: "perfect 4th", 6: "tritone", 7: "perfect 5th", 8: "minor 6th", 9: "major 6th", 10: "minor 7th", 11: "major 7th", 12: "octave"}
 TEMPO_MARKS = {"grave": (20, 40), "largo": (40, 60), "adagio": (60, 80), "andante": (80, 100), "moderato": (100, 120), "allegretto": (112, 130), "allegro": (120, 160), "vivace": (160, 180), "presto": (180, 220), "prestissimo": (220, 280)}
 SCALES = {
@@ -28,48 +182,264 @@ SCALES = {
 DYNAMICS = {"ppp": ("pianississimo", 1), "pp": ("pianissimo", 2), "p": ("piano", 3), "mp": ("mezzo-piano", 4), "mf": ("mezzo-forte", 5), "f": ("forte", 6), "ff": ("fortissimo", 7), "fff": ("fortississimo", 8)}
 INSTRUMENTS = {"violin": ("strings", "A3-E7", "soprano"), "viola": ("strings", "C3-E6", "alto"), "cello": ("strings", "C2-C6", "tenor/bass"), "double bass": ("strings", "E1-G4", "bass"), "bass": ("strings", "E1-G4", "bass"), "flute": ("woodwinds", "C4-D7", "soprano"), "piccolo": ("woodwinds", "D5-C8", "soprano"), "oboe": ("woodwinds", "Bb3-A6", "soprano"), "clarinet": ("woodwinds", "D3-Bb6", "soprano"), "bassoon": ("woodwinds", "Bb1-Eb5", "bass"), "saxophone": ("woodwinds", "Bb3-F#6", "alto"), "trumpet": ("brass", "F#3-D6", "soprano"), "french horn": ("brass", "B1-F5", "alto"), "horn": ("brass", "B1-F5", "alto"), "trombone": ("brass", "E2-F5", "tenor"), "tuba": ("brass", "D1-F4", "bass"), "timpani": ("percussion", "D2-C4", "bass"), "snare": ("percussion", "N/A", "unpitched"), "drum": ("percussion", "N/A", "unpitched"), "cymbal": ("percussion", "N/A", "unpitched"), "triangle": ("percussion", "N/A", "unpitched"), "xylophone": ("percussion", "F4-C8", "soprano"), "marimba": ("percussion", "C2-C7", "full"), "piano": ("keyboard", "A0-C8", "full"), "harp": ("strings", "Cb1-G#7", "full"), "organ": ("keyboard", "C2-C7", "full"), "guitar": ("strings", "E2-E6", "alto"), "celesta": ("keyboard", "C4-C8", "soprano")}
 
-def parse_notes(text):
-    found = []
-    for token in re.findall(r'[A-Ga-g][#b]?\d?', text):
-        note = token[0].upper()
-        if len(token) > 1 and token[1] in '#b':
-            if token[1] == 'b':
-                idx = NOTE_LIST.index(note) - 1 if note in NOTE_LIST else -1
-                if idx >= 0:
-                    note = NOTE_LIST[idx]
-                else:
+SENTIMENTS = {"beautiful": "positive", "great": "positive", "good": "positive", "excellent": "positive", "nice": "positive", "perfect": "positive", "bad": "negative", "wrong": "negative", "off": "negative", "terrible": "negative", "poor": "negative", "sharp": "sharp", "flat": "flat", "fast": "fast", "rushing": "fast", "slow": "slow", "dragging": "slow", "loud": "loud", "quiet": "soft", "soft": "soft", "muddy": "muddy", "thin": "thin", "bright": "bright", "dark": "dark", "harsh": "harsh", "warm": "warm"}
+HAIRPINS = {"crescendo": "cresc", "cresc": "cresc", "decrescendo": "decresc", "decresc": "decresc", "diminuendo": "decresc"}
+SCALE_ALIASES = {**{name: name for name in SCALES}, "minor": "natural minor", "pentatonic": "pentatonic major"}
+
+Token = namedtuple("Token", "kind value")
+
+# Every keyword maps to the token it produces. Phrases are matched longest
+# first, so "french horn" never also yields "horn", and whole words only, so
+# "bassoon" never yields "bass" and "sharp" never yields "harp".
+KEYWORDS = {**{w: ("sentiment", c) for w, c in SENTIMENTS.items()}, **{w: ("hairpin", h) for w, h in HAIRPINS.items()},
+            **{m: ("tempo", m) for m in TEMPO_MARKS}, **{i: ("instrument", i) for i in INSTRUMENTS}}
+
+def _phrase_table(phrases):
+    table = {}
+    for phrase in sorted(phrases, key=lambda p: len(p.split()), reverse=True):
+        words = tuple(phrase.split())
+        table.setdefault(words[0], []).append(words)
+    return table
+
+KEYWORD_PHRASES = _phrase_table(KEYWORDS)
+SCALE_PHRASES = _phrase_table(SCALE_ALIASES)
+VOCABULARY = {w for p in list(KEYWORDS) + list(SCALE_ALIASES) for w in p.split()}
+WORD = re.compile(r"[\w#]+")
+NOTE_WORD = re.compile(r"(?:[A-G][#b]?\d?)+|[a-g][#b]?\d?")
+NOTE_ROOT = re.compile(r"[A-Ga-g][#b]?")
+NOTE_TOKEN = re.compile(r"([A-Ga-g])([#b]?)(\d?)")
+
+def note_name(letter, accidental=""):
+    note = letter.upper()
+    if accidental == "#":
+        return note + "#"
+    if accidental == "b":
+        idx = NOTE_INDEX[note] - 1
+        return NOTE_LIST[idx] if idx >= 0 else None
+    return note
+
+def _note_words():
+    # The note token of every single-note spelling ("c", "Eb", "F#4"); a lone "f" is the
+    # dynamic, and a lone "a" is left to lex, which reads it as a note only among notes.
+    table = {}
+    for letter in "ABCDEFGabcdefg":
+        for accidental in ("", "#", "b"):
+            for octave in ("", *"0123456789"):
+                m = note_midi(letter, accidental, octave)
+                if m is not None:
+                    table[letter + accidental + octave] = Token("note" if octave else "pitch", m)
+    del table["f"], table["a"]
+    return table
+
+def _among_notes(raw, i):
+    """Whether the words next to raw[i] are all notes; "a" alone or in a sentence is the article."""
+    sides = [raw[j] for j in (i - 1, i + 1) if 0 <= j < len(raw)]
+    return bool(sides) and all(w in NOTE_WORDS or w[0].isupper() and NOTE_WORD.fullmatch(w) for w in sides)
+
+def note_midi(letter, accidental="", octave=""):
+    """MIDI number of a spelled note; Cb4 is B3 and B#3 is C4. None if out of range.
+    Without an octave the note is spelled in DEFAULT_OCTAVE (see place_notes)."""
+    m = (int(octave) if octave else DEFAULT_OCTAVE) * 12 + 12 + NOTE_INDEX[letter.upper()] + {"#": 1, "b": -1}.get(accidental, 0)
+    return m if 0 <= m < 128 else None
+
+def _singular(word):
+    if word[-1] != "s" or word in VOCABULARY:
+        return word
+    if word[:-1] in VOCABULARY:
+        return word[:-1]
+    return word[:-2] if word.endswith("es") and word[:-2] in VOCABULARY else word
+
+def _match(words, i, table):
+    for phrase in table.get(words[i], ()):
+        if tuple(words[i:i + len(phrase)]) == phrase:
+            return " ".join(phrase), i + len(phrase)
+    return None, i
+
+def lex(text):
+    """Scan text once and return its Token stream.
+
+    Dynamics are case-insensitive except a lone "F", which is the note. Note
+    names are standalone letters ("c", "Eb4") or runs of capitals ("CEG", "F#A");
+    a note with an octave is a "note" token, one without is a "pitch" token.
+    """
+    # Pasted melodies are all note words; the whitespace split finds the same words then.
+    notes = list(map(NOTE_WORDS.get, text.split()))
+    if None not in notes:
+        return notes
+    raw = WORD.findall(text)
+    notes = list(map(NOTE_WORDS.get, raw))
+    words = [_singular(w.lower()) for w in raw]
+    tokens = []
+    i, n = 0, len(raw)
+    while i < n:
+        word, low = raw[i], words[i]
+        if notes[i]:
+            # A run of note words is taken whole; only its last note can start a scale name.
+            try:
+                end = notes.index(None, i)
+            except ValueError:
+                end = n
+            if end < n and words[end] in SCALE_PHRASES:
+                end -= 1
+            if end > i:
+                tokens += notes[i:end]
+                i = end
+                continue
+        if low in KEYWORD_PHRASES:
+            phrase, end = _match(words, i, KEYWORD_PHRASES)
+            if phrase:
+                tokens.append(Token(*KEYWORDS[phrase]))
+                i = end
+                continue
+        i += 1
+        first = word[0]
+        if first in "ABCDEFGabcdefg":
+            if i < n and words[i] in SCALE_PHRASES and NOTE_ROOT.fullmatch(word):
+                scale_type, end = _match(words, i, SCALE_PHRASES)
+                if scale_type:
+                    root = note_name(first, word[1:])
+                    if root:
+                        tokens.append(Token("scale", (root, scale_type, SCALE_ALIASES[scale_type])))
+                    i = end
                     continue
-            else:
-                note += '#'
-        if note in NOTES:
-            found.append(note)
-    return found
+            if low in DYNAMICS and word != "F":
+                tokens.append(Token("dynamic", low))
+            elif NOTE_WORD.fullmatch(word) and (word != "a" or _among_notes(raw, i - 1)):
+                for letter, accidental, octave in NOTE_TOKEN.findall(word):
+                    note = note_midi(letter, accidental, octave)
+                    if note is not None:
+                        tokens.append(Token("note" if octave else "pitch", note))
+        elif low in DYNAMICS:
+            tokens.append(Token("dynamic", low))
+        elif first.isdigit():
+            if low.isdigit() and i < n and words[i] == "bpm":
+                tokens.append(Token("bpm", int(low)))
+                i += 1
+            elif low.endswith("bpm") and low[:-3].isdigit():
+                tokens.append(Token("bpm", int(low[:-3])))
+    return tokens
 
-def detect_key(notes):
-    if len(notes) < 3:
+NOTE_WORDS = _note_words()
+
+def place_notes(tokens, previous=None):
+    """MIDI numbers of the note and pitch tokens, in order, as a compact array("B").
+    A pitch (no octave written) goes in the octave nearest the note before it, so
+    "B C" steps up a minor 2nd; the first one stays in DEFAULT_OCTAVE."""
+    if len(tokens) >= 64:
+        placed = _place_notes_np(tokens, previous)
+        if placed is not None:
+            return placed
+    notes = array("B")
+    for kind, value in tokens:
+        if kind == "pitch":
+            if previous is not None:
+                value = previous + (value - previous + 6) % 12 - 6
+                value += 12 if value < 0 else -12 if value > 127 else 0
+        elif kind != "note":
+            continue
+        notes.append(value)
+        previous = value
+    return notes
+
+def _place_notes_np(tokens, previous):
+    # Placing a pitch keeps its pitch class, so each step from the note before depends
+    # only on the spelled values: within a run that starts at a note with an octave,
+    # positions are a cumulative sum. None if a note would leave the MIDI range, where
+    # the loop's octave wrap applies.
+    kinds, values = zip(*tokens)
+    kinds = np.array(kinds, dtype=object)
+    pitch = kinds == "pitch"
+    keep = pitch | (kinds == "note")
+    if not keep.all():
+        values = [v for v, k in zip(values, keep.tolist()) if k]
+        pitch = pitch[keep]
+    if not len(values):
+        return array("B")
+    v = np.array(values, dtype=np.int32)
+    prev = np.empty_like(v)
+    prev[0] = v[0] if previous is None else previous
+    prev[1:] = v[:-1]
+    steps = np.cumsum(np.where(pitch, (v - prev + 6) % 12 - 6, 0))
+    starts = ~pitch
+    starts[0] = True
+    start_at = np.maximum.accumulate(np.where(starts, np.arange(len(v)), 0))
+    base = np.where(starts, v, 0)
+    if pitch[0] and previous is not None:
+        base[0] = previous + steps[0]
+    placed = base[start_at] + steps - steps[start_at]
+    if placed.min() < 0 or placed.max() > 127:
         return None
-    indices = list(set(NOTE_LIST.index(n) for n in notes))
-    best_key, best_scale, best_score = None, None, -1
-    for root_idx in range(12):
-        for scale_name, pattern in SCALES.items():
-            shifted = set((root_idx + p) % 12 for p in pattern)
-            score = len(set(indices) & shifted)
-            if score > best_score:
-                best_score = score
-                best_key = NOTE_LIST[root_idx]
-                best_scale = scale_name
-    match_pct = round(best_score / len(set(indices)) * 100) if indices else 0
-    return {"key": best_key, "scale": best_scale, "match": match_pct}
+    return array("B", placed.astype(np.uint8).tobytes())
+
+def parse_notes(text, previous=None):
+    """MIDI numbers of the notes in text; `previous` places a leading octave-less note."""
+    return place_notes(lex(text), previous)
+
+def pc_mask(pcs):
+    mask = 0
+    for pc in pcs:
+        mask |= 1 << (pc % 12)
+    return mask
+
+def _key_index(k):
+    # Every mask against every scale at once: popcount(mask & scale) via a 4096-entry table.
+    bits = np.array([m.bit_count() for m in range(4096)])
+    scores = bits[np.arange(4096)[:, None] & np.array([m for _, _, m in SCALE_MASKS])]
+    # The chromatic scale contains every set, so on a tie it ranks behind real keys;
+    # remaining ties keep SCALE_MASKS order, so every rank is unique.
+    n = len(SCALE_MASKS)
+    rank = (2 * scores + np.array([name != "chromatic" for _, name, _ in SCALE_MASKS])) * n - np.arange(n)
+    top = np.argpartition(-rank, k, axis=1)[:, :k]
+    top = np.take_along_axis(top, np.argsort(-np.take_along_axis(rank, top, axis=1), axis=1), axis=1)
+    with np.errstate(invalid="ignore"):
+        match = np.rint(np.take_along_axis(scores, top, axis=1) / bits[:, None] * 100)
+    labels = [(NOTE_LIST[root], name) for root, name, _ in SCALE_MASKS]
+    return [()] + [tuple((*labels[i], int(m)) for i, m in zip(row, matches)) for row, matches in zip(top.tolist()[1:], match.tolist()[1:])]
+
+# Pitch-class sets are 12-bit masks (bit n = NOTE_LIST[n]); every table below is
+# indexed by mask so key and chord lookups are a single list access.
+CHORDS = {(0, 4, 7): "major", (0, 3, 7): "minor", (0, 3, 6): "diminished", (0, 4, 8): "augmented", (0, 4, 7, 11): "major 7th", (0, 4, 7, 10): "dominant 7th", (0, 3, 7, 10): "minor 7th", (0, 3, 6, 9): "diminished 7th", (0, 3, 6, 10): "half-diminished 7th", (0, 4, 7, 9): "major 6th", (0, 5, 7): "sus4", (0, 2, 7): "sus2", (0, 4, 7, 14): "add9"}
+KEY_TOP_K = 5
+SCALE_MASKS = [(root, name, pc_mask(root + p for p in pattern)) for root in range(12) for name, pattern in SCALES.items()]
+KEY_INDEX = _key_index(KEY_TOP_K)
+# Score key tracking names major and minor keys only, not modes that share their notes.
+# A minor key spans natural and harmonic minor, so the leading tone coming and going
+# within a passage is not a change of key.
+TONAL_SCALES = {"major": SCALES["major"], "minor": SCALES["natural minor"] + SCALES["harmonic minor"]}
+TONAL_MASKS = [(root, name, pc_mask(root + p for p in pattern)) for root in range(12) for name, pattern in TONAL_SCALES.items()]
+# Aarden-Essen key profiles (weight of each scale degree from the tonic), used to
+# pick between keys whose scales fit a histogram equally well.
+MAJOR_PROFILE = (17.77, 0.15, 14.93, 0.16, 19.8, 11.36, 0.29, 22.06, 0.15, 8.15, 0.23, 4.95)
+MINOR_PROFILE = (18.26, 0.74, 14.05, 16.86, 0.7, 14.44, 0.7, 18.62, 4.57, 1.93, 7.38, 1.76)
+TONAL_PROFILES = np.array([np.roll(MAJOR_PROFILE if name == "major" else MINOR_PROFILE, root) for root, name, _ in TONAL_MASKS])
+TONAL_PROFILES -= TONAL_PROFILES.mean(axis=1, keepdims=True)
+TONAL_PROFILES /= np.linalg.norm(TONAL_PROFILES, axis=1, keepdims=True)
+TONAL_DEGREES = np.array([[m >> pc & 1 for pc in range(12)] for _, _, m in TONAL_MASKS])
+CHORD_INDEX = [None] * 4096
+for _ints, _name in CHORDS.items():
+    CHORD_INDEX[pc_mask(_ints)] = _name
+
+def notes_mask(notes):
+    if len(notes) < 64:
+        return pc_mask(notes)
+    return int(np.bitwise_or.reduce(np.left_shift(1, np.asarray(notes, dtype=np.int16) % 12)))
+
+def key_candidates(notes, k=3):
+    if len(notes) < 3:
+        return []
+    return [{"key": key, "scale": scale, "match": match} for key, scale, match in KEY_INDEX[notes_mask(notes)][:k]]
+
+def detect_key(notes):
+    candidates = key_candidates(notes, 1)
+    return candidates[0] if candidates else None
 
 def get_chord_name(notes):
     if len(notes) < 3:
         return None
-    indices = [NOTE_LIST.index(n) % 12 for n in notes[:4]]
-    root = notes[0]
-    ints = [(indices[i] - indices[0]) % 12 for i in range(len(indices))]
-    chords = {(0, 4, 7): "major", (0, 3, 7): "minor", (0, 3, 6): "diminished", (0, 4, 8): "augmented", (0, 4, 7, 11): "major 7th", (0, 4, 7, 10): "dominant 7th", (0, 3, 7, 10): "minor 7th", (0, 3, 6, 9): "diminished 7th", (0, 3, 6, 10): "half-diminished 7th", (0, 4, 7, 9): "major 6th", (0, 5, 7): "sus4", (0, 2, 7): "sus2", (0, 4, 7, 14): "add9"}
-    t = tuple(sorted(set(ints)))
-    name = chords.get(t, None)
+    indices = [m % 12 for m in notes[:4]]
+    root = NOTE_LIST[indices[0]]
+    ints = [(i - indices[0]) % 12 for i in indices]
+    name = CHORD_INDEX[pc_mask(ints)]
     if name:
         return f"{root} {name}"
     if len(ints) >= 3:
@@ -90,62 +460,295 @@ def cents_between(f1, f2):
         return 0
     return round(1200 * math.log2(f2 / f1), 1)
 
-def analyze_local(data):
-    if not data or not data.strip():
-        return "🎼 Welcome to Symphony Conductor AI!\n\n🎯 What you can do:\n• Enter notes: C E G B\n• Add tempo: allegro, 120 bpm\n• Name instruments: violin, trumpet, flute\n• Describe issues: sounds flat, too fast, brass too loud\n• Try dynamics: ff, pp, crescendo\n• Ask for scales: C major scale, A minor\n\n💡 Combine them: \"C E G allegro violin ff\""
-    text = data.strip()
-    lines = []
-    notes = parse_notes(text)
-    lower = text.lower()
+@dataclass(slots=True)
+class Interval:
+    start: str
+    end: str
+    name: str
+    semitones: int
+    cents: float
+    consonant: bool
+
+@dataclass(slots=True)
+class KeyCandidate:
+    key: str
+    scale: str
+    match: int
+
+@dataclass(slots=True)
+class Tempo:
+    marking: str
+    bpm: int
+    beat_ms: int
+
+@dataclass(slots=True)
+class Dynamic:
+    mark: str
+    name: str
+    level: int
+
+@dataclass(slots=True)
+class Instrument:
+    name: str
+    section: str
+    range: str
+    voice: str
+
+@dataclass(slots=True)
+class ScaleInfo:
+    root: str
+    type: str
+    notes: list
+    freqs: list
+    pattern: list
+    relative: str | None = None
+
+@dataclass(slots=True)
+class DetectedNote:
+    note: str
+    octave: int
+    start: float
+    duration: float
+    hz: float
+    cents: float
+
+@dataclass(slots=True)
+class AudioTrack:
+    sample_rate: int
+    seconds: float
+    frames: int
+    voiced: int
+    notes: list = field(default_factory=list)
+
+@dataclass(slots=True)
+class KeyChange:
+    measure: str
+    key: str
+    scale: str
+    match: int
+
+@dataclass(slots=True)
+class ScoreInfo:
+    source: str
+    parts: int
+    measures: int
+    notes: int
+    lowest: str | None = None
+    highest: str | None = None
+    window: int = 0
+    key_changes: list = field(default_factory=list)
+
+@dataclass(slots=True)
+class Analysis:
+    """Everything analyze() extracts from one input; renderers turn it into text, JSON or HTML."""
+    excerpt: str = ""
+    notes: list = field(default_factory=list)
+    midi: list = field(default_factory=list)
+    freqs: list = field(default_factory=list)
+    intervals: list = field(default_factory=list)
+    range_hz: float = 0.0
+    doubled: list = field(default_factory=list)
+    chord: str | None = None
+    keys: list = field(default_factory=list)
+    tempo: Tempo | None = None
+    dynamics: list = field(default_factory=list)
+    crescendo: bool = False
+    diminuendo: bool = False
+    instruments: list = field(default_factory=list)
+    sections: dict = field(default_factory=dict)
+    sentiments: list = field(default_factory=list)
+    scale: ScaleInfo | None = None
+    audio: AudioTrack | None = None
+    score: ScoreInfo | None = None
+
+def interval_name(semitones):
+    octaves, size = divmod(abs(semitones), 12)
+    if size == 0 and octaves:
+        return "octave" if octaves == 1 else f"{octaves} octaves"
+    return INTERVALS[size] + (f" + {octaves} octave{'s' if octaves > 1 else ''}" if octaves else "")
+
+INTERVAL_TABLE = {}
+
+def make_interval(pair):
+    m1, m2 = divmod(pair, 128)
+    st = m2 - m1
+    iv = INTERVAL_TABLE[pair] = Interval(MIDI_NAMES[m1], MIDI_NAMES[m2], interval_name(st), st,
+                                         cents_between(float(MIDI_FREQS[m1]), float(MIDI_FREQS[m2])), st % 12 in CONSONANT_STEPS)
+    return iv
+
+def analyze_notes(a, notes, clock, freqs=None):
+    """Fill the pitch, interval and harmony fields of `a` from a sequence of MIDI numbers."""
+    midi = np.asarray(notes, dtype=np.int16)
+    a.midi = midi.tolist()
+    a.notes = [MIDI_NAMES[m] for m in a.midi]
+    if len(midi):
+        hz = MIDI_FREQS[midi] if freqs is None else np.asarray(freqs, dtype=float)
+        a.freqs = hz.tolist()
+        a.range_hz = round(float(hz.max() - hz.min()), 2)
+        pcs = midi % 12
+        counts = np.bincount(pcs, minlength=12)
+        first = np.full(12, len(pcs))
+        np.minimum.at(first, pcs, np.arange(len(pcs)))
+        a.doubled = [NOTE_LIST[pc] for pc in sorted(np.flatnonzero(counts > 1).tolist(), key=first.__getitem__)]
+    if len(midi) > 1 and freqs is None:
+        # Equal-tempered intervals depend only on the pair of notes, so each
+        # distinct pair is built once and shared.
+        pairs = (midi[:-1] * 128 + midi[1:]).tolist()
+        a.intervals = [INTERVAL_TABLE.get(p) or make_interval(p) for p in pairs]
+    elif len(midi) > 1:
+        steps = np.diff(midi).tolist()
+        cents = np.round(1200 * np.log2(hz[1:] / hz[:-1]), 1).tolist()
+        a.intervals = [Interval(start, end, interval_name(st), st, c, st % 12 in CONSONANT_STEPS)
+                       for start, end, st, c in zip(a.notes, a.notes[1:], steps, cents)]
+    clock.lap("pitch")
+    if len(midi) >= 3:
+        a.chord = get_chord_name(a.midi)
+        clock.lap("get_chord_name")
+        a.keys = [KeyCandidate(**c) for c in key_candidates(a.midi)]
+        clock.lap("detect_key")
+
+def analyze(data):
+    text = (data or "").strip()
+    a = Analysis(excerpt=text[:100])
+    if not text:
+        return a
+    clock = StageClock()
+    found = {}
+    tokens = lex(text)
+    for kind, value in tokens:
+        if kind != "note" and kind != "pitch":  # notes go to place_notes below
+            found.setdefault(kind, []).append(value)
+    clock.lap("lex")
+
+    analyze_notes(a, place_notes(tokens), clock)
 
     tempo = None
     bpm = None
-    for mark, (lo, hi) in TEMPO_MARKS.items():
-        if mark in lower:
-            tempo = mark
-            bpm = (lo + hi) // 2
-            break
-    bpm_match = re.search(r'(\d+)\s*bpm', lower)
-    if bpm_match:
-        bpm = int(bpm_match.group(1))
+    if "tempo" in found:
+        tempo = found["tempo"][0]
+        lo, hi = TEMPO_MARKS[tempo]
+        bpm = (lo + hi) // 2
+    if "bpm" in found:
+        bpm = found["bpm"][0]
         for mark, (lo, hi) in TEMPO_MARKS.items():
             if lo <= bpm <= hi:
                 tempo = mark
                 break
+    if tempo:
+        a.tempo = Tempo(tempo, bpm, round(60000 / bpm) if bpm else 0)
+    clock.lap("tempo")
 
+    dynamics = set(found.get("dynamic", []))
+    a.dynamics = [Dynamic(d, name, level) for d, (name, level) in DYNAMICS.items() if d in dynamics]
+    hairpins = found.get("hairpin", [])
+    a.crescendo = "cresc" in hairpins
+    a.diminuendo = "decresc" in hairpins
+    clock.lap("dynamics")
+
+    named = set(found.get("instrument", []))
+    for inst, (sec, rng, voice) in INSTRUMENTS.items():
+        if inst in named:
+            a.instruments.append(Instrument(inst, sec, rng, voice))
+            a.sections.setdefault(sec, []).append(inst)
+    clock.lap("instruments")
+
+    a.sentiments = list(dict.fromkeys(found.get("sentiment", [])))
+    if "scale" in found:
+        root, scale_type, scale_key = found["scale"][0]
+        if root:
+            root_idx = NOTE_INDEX[root]
+            scale_notes = [NOTE_LIST[(root_idx + s) % 12] for s in SCALES[scale_key]]
+            relative = None
+            if scale_type in ["major", "minor", "natural minor"]:
+                relative = NOTE_LIST[(root_idx + (9 if 'major' in scale_type else 3)) % 12]
+            a.scale = ScaleInfo(root, scale_type, scale_notes, [NOTES[n] for n in scale_notes], SCALES[scale_key], relative)
+    clock.lap("feedback")
+    return a
+
+FEEDBACK = {
+    "positive": "👍 Positive assessment — maintain current approach and energy",
+    "negative": "🔧 Issues detected — isolate problem passages, drill slowly with metronome",
+    "sharp": "📐 Sharp intonation — relax embouchure, extend slides, use less air pressure",
+    "flat": "📐 Flat intonation — increase air support, shorten slides, firm embouchure",
+    "fast": "⏩ Rushing tendency — internalize subdivision, anchor to bass pulse",
+    "slow": "⏪ Dragging tendency — feel forward motion, anticipate beats slightly",
+    "loud": "🔊 Excessive volume — reduce intensity, listen across the ensemble",
+    "soft": "🔉 Insufficient projection — increase air support, maintain tone core",
+    "muddy": "🌫️ Lack of clarity — lighten articulation, reduce pedal, separate voices",
+    "thin": "📏 Thin sound — add vibrato, use fuller bow/air, check doubling",
+    "bright": "☀️ Bright timbre — good for projecting melody; soften for blending",
+    "dark": "🌙 Dark timbre — rich and warm; increase for bass, lighten for solos",
+    "harsh": "⚡ Harsh tone — ease up on attack, use softer articulation",
+    "warm": "🔥 Warm tone — beautiful quality, ideal for lyrical passages",
+}
+
+def render_text(a):
+    if not a.excerpt:
+        return "🎼 Welcome to Symphony Conductor AI!\n\n🎯 What you can do:\n• Enter notes: C E G B\n• Add tempo: allegro, 120 bpm\n• Name instruments: violin, trumpet, flute\n• Describe issues: sounds flat, too fast, brass too loud\n• Try dynamics: ff, pp, crescendo\n• Ask for scales: C major scale, A minor\n\n💡 Combine them: \"C E G allegro violin ff\""
+    lines = []
+    if a.audio:
+        track = a.audio
+        lines.append("━━━ 🎙️ AUDIO PITCH TRACK ━━━")
+        lines.append(f"Recording: {track.seconds:.1f} s at {track.sample_rate} Hz | {len(track.notes)} notes detected | pitched in {100 * track.voiced // max(track.frames, 1)}% of frames")
+        for d in track.notes[:AUDIO_LIST_NOTES]:
+            tuning = "in tune" if abs(d.cents) <= INTONATION_CENTS else ("sharp" if d.cents > 0 else "flat")
+            lines.append(f"  {d.start:6.2f}s {d.note}{d.octave}: {d.hz:.1f} Hz, {d.cents:+.1f} cents ({tuning}), {d.duration:.2f}s")
+        if len(track.notes) > AUDIO_LIST_NOTES:
+            lines.append(f"  … {len(track.notes) - AUDIO_LIST_NOTES} more")
+        off = [d for d in track.notes if abs(d.cents) > INTONATION_CENTS]
+        if off:
+            lines.append(f"📐 {len(off)} of {len(track.notes)} notes more than {INTONATION_CENTS} cents off pitch — check tuning")
+        lines.append("")
+    if a.score:
+        sc = a.score
+        lines.append("━━━ 📜 SCORE ━━━")
+        lines.append(f"Source: {'MIDI file' if sc.source == 'midi' else 'MusicXML'}, {sc.parts} {'tracks' if sc.source == 'midi' else 'parts'} | {sc.measures} measures | {sc.notes} notes")
+        lines.append(f"Range: {sc.lowest} – {sc.highest} ({a.range_hz:.0f} Hz)")
+        if a.keys:
+            lines.append(f"Overall key: {a.keys[0].key} {a.keys[0].scale} ({a.keys[0].match}% match)")
+            if len(a.keys) > 1:
+                lines.append("Also fits: " + ", ".join(f"{c.key} {c.scale} ({c.match}%)" for c in a.keys[1:]))
+        if sc.key_changes:
+            lines.append("")
+            lines.append(f"━━━ 🔀 KEY MAP ({sc.window}-measure window) ━━━")
+            previous = None
+            for ch in sc.key_changes:
+                line = f"  m. {ch.measure}: {ch.key} {ch.scale} ({ch.match}%)"
+                if previous:
+                    line += f" — modulation, root up a {INTERVALS[(NOTE_INDEX[ch.key] - NOTE_INDEX[previous.key]) % 12]}" if ch.key != previous.key else f" — change of mode from {previous.scale}"
+                lines.append(line)
+                previous = ch
+            if len(sc.key_changes) > 1:
+                lines.append(f"🧭 {len(sc.key_changes) - 1} modulation{'s' if len(sc.key_changes) > 2 else ''} — mark the new key areas for the players")
+        lines.append("")
+    notes = a.notes
     if notes:
         lines.append(f"━━━ 🎼 PITCH ANALYSIS ━━━")
         lines.append(f"Notes: {' → '.join(notes)}")
-        freqs = [NOTES[n] for n in notes]
-        lines.append(f"Frequencies: {', '.join(f'{f:.1f} Hz' for f in freqs)}")
+        lines.append(f"Frequencies: {', '.join(f'{f:.1f} Hz' for f in a.freqs)}")
 
-        if len(notes) >= 2:
+        if a.intervals:
             lines.append("")
             lines.append("━━━ 🎹 INTERVAL ANALYSIS ━━━")
-            for i in range(len(notes) - 1):
-                idx1 = NOTE_LIST.index(notes[i])
-                idx2 = NOTE_LIST.index(notes[i + 1])
-                semitones = (idx2 - idx1) % 12
-                name = INTERVALS.get(semitones, f"{semitones} semitones")
-                c = cents_between(NOTES[notes[i]], NOTES[notes[i + 1]])
-                consonance = "consonant" if semitones in [0, 3, 4, 5, 7, 8, 9, 12] else "dissonant"
-                lines.append(f"  {notes[i]} → {notes[i+1]}: {name} ({semitones} st, {abs(c)} cents) [{consonance}]")
+            for iv in a.intervals:
+                lines.append(f"  {iv.start} → {iv.end}: {iv.name} ({iv.semitones} st, {abs(iv.cents)} cents) [{'consonant' if iv.consonant else 'dissonant'}]")
 
         if len(notes) >= 3:
             lines.append("")
             lines.append("━━━ 🏛️ HARMONY ━━━")
-            chord = get_chord_name(notes)
-            if chord:
-                lines.append(f"Chord: {chord}")
-            key_info = detect_key(notes)
-            if key_info:
-                lines.append(f"Likely key: {key_info['key']} {key_info['scale']} ({key_info['match']}% match)")
-                if key_info['match'] < 70:
+            if a.chord:
+                lines.append(f"Chord: {a.chord}")
+            if a.keys:
+                key_info = a.keys[0]
+                lines.append(f"Likely key: {key_info.key} {key_info.scale} ({key_info.match}% match)")
+                if len(a.keys) > 1:
+                    lines.append("Also fits: " + ", ".join(f"{c.key} {c.scale} ({c.match}%)" for c in a.keys[1:]))
+                if key_info.match < 70:
                     lines.append("⚠️ Low key confidence — chromatic or atonal passage detected")
 
         lines.append("")
         lines.append("━━━ 🎯 CONDUCTOR FEEDBACK ━━━")
-        pitch_range = max(freqs) - min(freqs)
+        pitch_range = a.range_hz
         if pitch_range < 30:
             lines.append("✅ Very tight voicing — excellent unison potential")
         elif pitch_range < 100:
@@ -155,10 +758,8 @@ def analyze_local(data):
         else:
             lines.append("⚠️ Wide register spread ({:.0f} Hz) — watch intonation across octaves".format(pitch_range))
 
-        unique_notes = list(set(notes))
-        if len(unique_notes) != len(notes):
-            doubled = [n for n in unique_notes if notes.count(n) > 1]
-            lines.append(f"🔁 Doubled notes: {', '.join(doubled)} — check octave placement")
+        if a.doubled:
+            lines.append(f"🔁 Doubled notes: {', '.join(a.doubled)} — check octave placement")
 
         if len(notes) == 1:
             lines.append("🎵 Single note — try adding more for harmony analysis")
@@ -169,11 +770,11 @@ def analyze_local(data):
         else:
             lines.append("🎵 Dense voicing ({} notes) — subdivide for clarity".format(len(notes)))
 
-    if tempo:
+    if a.tempo:
+        bpm, beat_ms = a.tempo.bpm, a.tempo.beat_ms
         lines.append("")
         lines.append("━━━ ⏱️ TEMPO & TIMING ━━━")
-        lines.append(f"Marking: {tempo.capitalize()} (~{bpm} BPM)")
-        beat_ms = round(60000 / bpm) if bpm else 0
+        lines.append(f"Marking: {a.tempo.marking.capitalize()} (~{bpm} BPM)")
         lines.append(f"Beat duration: {beat_ms} ms | Subdivision (16th): {beat_ms // 4} ms")
         if bpm < 60:
             lines.append("🐢 Very slow — sustain control and breath management critical")
@@ -191,37 +792,25 @@ def analyze_local(data):
             lines.append("🚀 Extreme speed — technical precision paramount")
             lines.append("💡 Reduce dynamics to maintain control, rehearse slowly first")
 
-    dyn_found = []
-    for d, (name, level) in DYNAMICS.items():
-        if re.search(r'\b' + re.escape(d) + r'\b', lower):
-            dyn_found.append((d, name, level))
-    cresc = "crescendo" in lower or "cresc" in lower
-    decresc = "decrescendo" in lower or "decresc" in lower or "diminuendo" in lower
-    if dyn_found or cresc or decresc:
+    if a.dynamics or a.crescendo or a.diminuendo:
         lines.append("")
         lines.append("━━━ 🔊 DYNAMICS ━━━")
-        for d, name, level in dyn_found:
-            bar = "█" * level + "░" * (8 - level)
-            lines.append(f"  {d} ({name}): [{bar}] {level}/8")
-        if cresc:
+        for d in a.dynamics:
+            bar = "█" * d.level + "░" * (8 - d.level)
+            lines.append(f"  {d.mark} ({d.name}): [{bar}] {d.level}/8")
+        if a.crescendo:
             lines.append("  📈 Crescendo — gradually increase intensity, keep pitch stable")
-        if decresc:
+        if a.diminuendo:
             lines.append("  📉 Diminuendo — reduce volume while maintaining tone quality")
 
-    found_instruments = {}
-    for inst, (section, rng, voice) in INSTRUMENTS.items():
-        if inst in lower:
-            found_instruments[inst] = (section, rng, voice)
-    if found_instruments:
+    if a.instruments:
         lines.append("")
         lines.append("━━━ 🎻 INSTRUMENTATION ━━━")
-        sections = {}
-        for inst, (sec, rng, voice) in found_instruments.items():
-            sections.setdefault(sec, []).append(inst)
-            lines.append(f"  {inst.title()}: {sec} | Range: {rng} | Voice: {voice}")
+        for inst in a.instruments:
+            lines.append(f"  {inst.name.title()}: {inst.section} | Range: {inst.range} | Voice: {inst.voice}")
         lines.append("")
-        lines.append("Section breakdown: " + " | ".join(f"{s}: {', '.join(i)}" for s, i in sections.items()))
-        sec_keys = set(sections.keys())
+        lines.append("Section breakdown: " + " | ".join(f"{s}: {', '.join(i)}" for s, i in a.sections.items()))
+        sec_keys = set(a.sections)
         if "brass" in sec_keys and "strings" in sec_keys:
             lines.append("⚖️ Balance: Brass naturally louder — mark strings mf+ or brass p/mp")
         if "woodwinds" in sec_keys and "brass" in sec_keys:
@@ -230,63 +819,28 @@ def analyze_local(data):
             lines.append("🥁 Percussion will define rhythmic clarity — ensure tight coordination")
         if len(sec_keys) >= 3:
             lines.append("🎭 Full orchestration — conductor must shape balance between sections")
-        if any(v == "soprano" for _, (_, _, v) in found_instruments.items()) and any(v == "bass" for _, (_, _, v) in found_instruments.items()):
+        if any(i.voice == "soprano" for i in a.instruments) and any(i.voice == "bass" for i in a.instruments):
             lines.append("📐 Wide voice range — middle voices (alto/tenor) crucial for blend")
 
-    if not notes and not tempo and not found_instruments and not dyn_found:
-        sentiments = {"beautiful": "positive", "great": "positive", "good": "positive", "excellent": "positive", "nice": "positive", "perfect": "positive", "bad": "negative", "wrong": "negative", "off": "negative", "terrible": "negative", "poor": "negative", "sharp": "sharp", "flat": "flat", "fast": "fast", "rushing": "fast", "slow": "slow", "dragging": "slow", "loud": "loud", "quiet": "soft", "soft": "soft", "muddy": "muddy", "thin": "thin", "bright": "bright", "dark": "dark", "harsh": "harsh", "warm": "warm"}
-        found_s = []
-        for w in lower.split():
-            if w in sentiments:
-                found_s.append(sentiments[w])
-
-        scale_match = re.search(r'([A-Ga-g][#b]?)\s*(major|minor|blues|pentatonic|dorian|mixolydian|phrygian|chromatic|whole tone)', lower)
-        if scale_match:
-            root = scale_match.group(1)[0].upper()
-            if len(scale_match.group(1)) > 1 and scale_match.group(1)[1] == '#':
-                root += '#'
-            scale_type = scale_match.group(2)
-            scale_key = scale_type
-            if scale_type == "major":
-                scale_key = "major"
-            elif scale_type == "minor":
-                scale_key = "natural minor"
-            if scale_key in SCALES and root in NOTE_LIST:
-                root_idx = NOTE_LIST.index(root)
-                scale_notes = [NOTE_LIST[(root_idx + s) % 12] for s in SCALES[scale_key]]
-                lines.append(f"━━━ 🎵 SCALE: {root} {scale_type.upper()} ━━━")
-                lines.append(f"Notes: {' '.join(scale_notes)}")
-                freqs = [NOTES[n] for n in scale_notes]
-                lines.append(f"Frequencies: {', '.join(f'{f:.1f}' for f in freqs)}")
-                lines.append(f"Pattern: {' '.join(str(s) for s in SCALES[scale_key])} (semitones from root)")
-                if scale_type in ["major", "minor", "natural minor"]:
-                    lines.append(f"Relative {'minor' if 'major' in scale_type else 'major'}: {NOTE_LIST[(root_idx + (9 if 'major' in scale_type else 3)) % 12]}")
-
-        if found_s:
+    if not notes and not a.tempo and not a.instruments and not a.dynamics:
+        if a.scale:
+            sc = a.scale
+            lines.append(f"━━━ 🎵 SCALE: {sc.root} {sc.type.upper()} ━━━")
+            lines.append(f"Notes: {' '.join(sc.notes)}")
+            lines.append(f"Frequencies: {', '.join(f'{f:.1f}' for f in sc.freqs)}")
+            lines.append(f"Pattern: {' '.join(str(s) for s in sc.pattern)} (semitones from root)")
+            if sc.relative:
+                lines.append(f"Relative {'minor' if 'major' in sc.type else 'major'}: {sc.relative}")
+
+        if a.sentiments:
             lines.append("")
             lines.append("━━━ 🔧 PERFORMANCE FEEDBACK ━━━")
-            feedback_map = {
-                "positive": "👍 Positive assessment — maintain current approach and energy",
-                "negative": "🔧 Issues detected — isolate problem passages, drill slowly with metronome",
-                "sharp": "📐 Sharp intonation — relax embouchure, extend slides, use less air pressure",
-                "flat": "📐 Flat intonation — increase air support, shorten slides, firm embouchure",
-                "fast": "⏩ Rushing tendency — internalize subdivision, anchor to bass pulse",
-                "slow": "⏪ Dragging tendency — feel forward motion, anticipate beats slightly",
-                "loud": "🔊 Excessive volume — reduce intensity, listen across the ensemble",
-                "soft": "🔉 Insufficient projection — increase air support, maintain tone core",
-                "muddy": "🌫️ Lack of clarity — lighten articulation, reduce pedal, separate voices",
-                "thin": "📏 Thin sound — add vibrato, use fuller bow/air, check doubling",
-                "bright": "☀️ Bright timbre — good for projecting melody; soften for blending",
-                "dark": "🌙 Dark timbre — rich and warm; increase for bass, lighten for solos",
-                "harsh": "⚡ Harsh tone — ease up on attack, use softer articulation",
-                "warm": "🔥 Warm tone — beautiful quality, ideal for lyrical passages",
-            }
-            for s in set(found_s):
-                if s in feedback_map:
-                    lines.append(feedback_map[s])
+            for s in a.sentiments:
+                if s in FEEDBACK:
+                    lines.append(FEEDBACK[s])
 
         if not lines:
-            lines.append(f"🎵 Input: \"{text[:100]}\"")
+            lines.append(f"🎵 Input: \"{a.excerpt}\"")
             lines.append("")
             lines.append("━━━ 💡 SUGGESTIONS ━━━")
             lines.append("Try any of these inputs:")
@@ -298,15 +852,823 @@ def analyze_local(data):
             lines.append("  • Feedback: sounds sharp, too fast, brass loud — conductor advice")
             lines.append("  • Combine: C E G allegro violin ff — full analysis")
 
-    return "\n".join(lines)
+    return "\n".join(lines).lstrip("\n")
+
+def render_text_timed(a):
+    start = time.perf_counter()
+    text = render_text(a)
+    STAGE_SECONDS.observe(time.perf_counter() - start, "render")
+    return text
+
+def render_json(a):
+    return orjson.dumps(a)
+
+def render_html(a):
+    """HTML fragment of the text rendering: one <section> per ━━━ block."""
+    parts = []
+    for block in render_text(a).split("\n\n"):
+        lines = block.splitlines()
+        if lines and lines[0].startswith("━━━"):
+            title, lines = lines[0].strip("━ "), lines[1:]
+            parts.append(f"<section><h3>{html.escape(title)}</h3><ul>" + "".join(f"<li>{html.escape(l.strip())}</li>" for l in lines) + "</ul></section>")
+        else:
+            parts.append("".join(f"<p>{html.escape(l.strip())}</p>" for l in lines))
+    return "\n".join(parts)
+
+RENDERERS = {"text": render_text, "json": render_json, "html": render_html}
+
+def analyze_local(data):
+    return render_text(analyze(data))
+
+# Audio: frames of AUDIO_FRAME samples every AUDIO_HOP samples, each run through
+# YIN (de Cheveigné & Kawahara, 2002) as one batched NumPy computation.
+AUDIO_FRAME = int(os.environ.get("AUDIO_FRAME", 2048))
+AUDIO_HOP = int(os.environ.get("AUDIO_HOP", 512))
+AUDIO_BATCH = int(os.environ.get("AUDIO_BATCH", 256))
+AUDIO_FMIN, AUDIO_FMAX = 40.0, 4200.0
+YIN_THRESHOLD = float(os.environ.get("YIN_THRESHOLD", 0.15))
+SILENCE_RMS = float(os.environ.get("SILENCE_RMS", 0.01))
+MIN_NOTE_SECONDS = float(os.environ.get("MIN_NOTE_SECONDS", 0.06))
+INTONATION_CENTS = 15
+AUDIO_LIST_NOTES = 64
+PCM_DTYPES = {(1, 8): "u1", (1, 16): "<i2", (1, 24): "i3", (1, 32): "<i4", (3, 32): "<f4", (3, 64): "<f8"}
+
+class AudioError(ValueError):
+    pass
+
+def yin(frames, sample_rate):
+    """Fundamental frequency of each row of `frames`, or NaN where unpitched."""
+    n, width = frames.shape
+    half = width // 2
+    tau_min = max(2, int(sample_rate / AUDIO_FMAX))
+    tau_max = min(half, int(sample_rate / AUDIO_FMIN) + 1)
+    frames = frames - frames.mean(axis=1, keepdims=True)
+    size = 1 << (width + half - 1).bit_length()
+    # d(tau) = sum_j (x_j - x_j+tau)^2 over the first half-frame, expanded into
+    # two energy terms and a cross-correlation that is done with one FFT per frame.
+    spectrum = np.fft.rfft(frames, size)
+    cross = np.fft.irfft(spectrum * np.conj(np.fft.rfft(frames[:, :half], size)), size)[:, :tau_max]
+    energy = np.concatenate([np.zeros((n, 1)), np.cumsum(frames * frames, axis=1)], axis=1)
+    taus = np.arange(tau_max)
+    diff = energy[:, half:half + 1] + energy[:, taus + half] - energy[:, taus] - 2 * cross
+    diff[:, 0] = 0
+    # Cumulative mean normalized difference; the first dip under the threshold is the period.
+    running = np.cumsum(diff[:, 1:], axis=1)
+    cmnd = np.ones_like(diff)
+    cmnd[:, 1:] = diff[:, 1:] * taus[1:] / np.where(running > 0, running, np.inf)
+    cmnd[:, 1:][running <= 0] = 1
+    dips = (cmnd[:, tau_min:-1] < YIN_THRESHOLD) & (cmnd[:, tau_min:-1] <= cmnd[:, tau_min + 1:])
+    found = dips.any(axis=1)
+    tau = dips.argmax(axis=1) + tau_min
+    rows = np.arange(n)
+    # Parabolic interpolation around the chosen lag for sub-sample precision.
+    left, mid, right = cmnd[rows, tau - 1], cmnd[rows, tau], cmnd[rows, np.minimum(tau + 1, tau_max - 1)]
+    denom = left - 2 * mid + right
+    shift = np.where(np.abs(denom) > 1e-12, 0.5 * (left - right) / np.where(denom == 0, 1, denom), 0)
+    rms = np.sqrt(energy[:, width] / width)
+    return np.where(found & (rms >= SILENCE_RMS), sample_rate / (tau + shift), np.nan)
+
+class PitchTracker:
+    """Turns a stream of mono float samples into notes. Holds at most one batch
+    of samples, the segment at the batch edge and the note currently sounding."""
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.buffer = np.zeros(0)
+        self.samples = self.frames = self.voiced = 0
+        self.tail = None  # last segment of the previous batch, which may continue
+        self.run = None  # [midi, first frame, frames spanned, sum of fractional midi, pitched frames]
+        self.min_frames = max(1, round(MIN_NOTE_SECONDS * sample_rate / AUDIO_HOP))
+        self.notes = []
+
+    def feed(self, samples):
+        self.samples += len(samples)
+        self.buffer = np.concatenate([self.buffer, samples])
+        while len(self.buffer) >= AUDIO_FRAME + AUDIO_HOP * (AUDIO_BATCH - 1):
+            self._process()
+
+    def finish(self):
+        while len(self.buffer) >= AUDIO_FRAME:
+            self._process()
+        if self.tail:
+            self._segment(*self.tail)
+        self._close()
+        return AudioTrack(self.sample_rate, round(self.samples / self.sample_rate, 3), self.frames, self.voiced, self.notes)
+
+    def _process(self):
+        frames = np.lib.stride_tricks.sliding_window_view(self.buffer, AUDIO_FRAME)[::AUDIO_HOP][:AUDIO_BATCH]
+        hz = yin(frames, self.sample_rate)
+        self.buffer = self.buffer[len(frames) * AUDIO_HOP:]
+        midi = 69 + 12 * np.log2(hz / 440.0)
+        nearest = np.where(np.isnan(midi), -1, np.rint(np.nan_to_num(midi))).astype(int)
+        starts = np.concatenate([[0], np.flatnonzero(nearest[1:] != nearest[:-1]) + 1])
+        sums = np.add.reduceat(np.where(nearest >= 0, midi, 0), starts)
+        lengths = np.diff(np.append(starts, len(nearest)))
+        segments = [list(seg) for seg in zip(nearest[starts].tolist(), (starts + self.frames).tolist(), lengths.tolist(), sums.tolist())]
+        if self.tail:
+            if self.tail[0] == segments[0][0]:
+                segments[0] = [self.tail[0], self.tail[1], self.tail[2] + segments[0][2], self.tail[3] + segments[0][3]]
+            else:
+                segments.insert(0, self.tail)
+        self.tail = segments.pop()
+        for segment in segments:
+            self._segment(*segment)
+        self.frames += len(frames)
+        self.voiced += int((nearest >= 0).sum())
+
+    def _segment(self, m, start, length, total):
+        run = self.run
+        if run and m == run[0] and start - (run[1] + run[2]) <= self.min_frames:
+            # Same pitch after at most a short dropout: one sustained note.
+            run[2] = start + length - run[1]
+            run[3] += total
+            run[4] += length
+        elif length >= self.min_frames:
+            self._close()
+            self.run = [m, start, length, total, length] if m >= 0 else None
+
+    def _close(self):
+        run, self.run = self.run, None
+        if run is None:
+            return
+        m, start, span, total, pitched = run
+        hz = 440.0 * 2 ** ((total / pitched - 69) / 12)
+        name, octave = NOTE_LIST[m % 12], m // 12 - 1
+        self.notes.append(DetectedNote(name, octave, round(start * AUDIO_HOP / self.sample_rate, 3), round(span * AUDIO_HOP / self.sample_rate, 3),
+                                       round(hz, 2), cents_between(NOTES[name] * 2.0 ** (octave - 4), hz)))
+
+class PcmDecoder:
+    """Incremental WAV/raw PCM decoder: bytes in, mono float64 samples out."""
+    def __init__(self, sample_rate=None, channels=1, bits=16):
+        self.pending = b""
+        self.header = sample_rate is None
+        if not self.header:
+            self._format(1, channels, sample_rate, bits)
+
+    def _format(self, code, channels, sample_rate, bits):
+        dtype = PCM_DTYPES.get((code, bits))
+        if dtype is None or channels < 1 or not 0 < sample_rate <= 384000:
+            raise AudioError(f"unsupported PCM: format {code}, {bits}-bit, {channels} channels, {sample_rate} Hz")
+        self.dtype, self.channels, self.sample_rate = dtype, channels, sample_rate
+        self.width = bits // 8 * channels
+
+    def feed(self, chunk):
+        data = self.pending + chunk
+        if self.header:
+            data = self._read_header(data)
+            if data is None:
+                self.pending += chunk
+                return None
+        usable = len(data) - len(data) % self.width
+        self.pending = data[usable:]
+        return self._samples(data[:usable])
+
+    def _read_header(self, data):
+        # RIFF/WAVE: walk chunks until "data"; returns the bytes after its header,
+        # or None while the header is incomplete.
+        if len(data) >= 4 and data[:4] != b"RIFF" or len(data) >= 12 and data[8:12] != b"WAVE":
+            raise AudioError("expected a RIFF/WAVE file or ?rate= for raw PCM")
+        pos, fmt = 12, None
+        while len(data) >= pos + 8:
+            kind, size = data[pos:pos + 4], int.from_bytes(data[pos + 4:pos + 8], "little")
+            if kind == b"data":
+                if fmt is None:
+                    raise AudioError("WAV data chunk before fmt chunk")
+                self.header = False
+                return data[pos + 8:]
+            if len(data) < pos + 8 + size:
+                return None
+            if kind == b"fmt ":
+                code, channels, sample_rate = int.from_bytes(data[pos + 8:pos + 10], "little"), int.from_bytes(data[pos + 10:pos + 12], "little"), int.from_bytes(data[pos + 12:pos + 16], "little")
+                bits = int.from_bytes(data[pos + 22:pos + 24], "little")
+                if code == 0xFFFE and size >= 40:  # WAVE_FORMAT_EXTENSIBLE: real code leads the subformat GUID
+                    code = int.from_bytes(data[pos + 32:pos + 34], "little")
+                self._format(code, channels, sample_rate, bits)
+                fmt = True
+            pos += 8 + size + size % 2
+        return None
+
+    def _samples(self, raw):
+        if not raw:
+            return np.zeros(0)
+        if self.dtype == "i3":
+            b = np.frombuffer(raw, np.uint8).reshape(-1, 3).astype(np.int32)
+            x = ((b[:, 0] | b[:, 1] << 8 | b[:, 2] << 16) << 8 >> 8) / float(1 << 23)
+        else:
+            x = np.frombuffer(raw, self.dtype)
+            if x.dtype.kind == "u":
+                x = (x.astype(np.float64) - 128) / 128
+            elif x.dtype.kind == "i":
+                x = x / float(1 << (8 * x.dtype.itemsize - 1))
+        return x.reshape(-1, self.channels).mean(axis=1)
+
+async def analyze_audio(chunks, sample_rate=None, channels=1, bits=16):
+    """Pitch-track an audio byte stream and run the note analysis on what was heard."""
+    decoder, tracker = PcmDecoder(sample_rate, channels, bits), None
+    async for chunk in chunks:
+        samples = decoder.feed(chunk)
+        if samples is None:
+            continue
+        if tracker is None:
+            tracker = PitchTracker(decoder.sample_rate)
+        if len(samples):
+            tracker.feed(samples)
+    if tracker is None:
+        raise AudioError("no audio data")
+    clock = StageClock()
+    track = tracker.finish()
+    clock.lap("audio")
+    a = Analysis(excerpt=f"audio: {track.seconds:.1f} s, {len(track.notes)} notes", audio=track)
+    analyze_notes(a, [(d.octave + 1) * 12 + NOTE_INDEX[d.note] for d in track.notes], clock, [d.hz for d in track.notes])
+    return a
+
+# Scores: notes are binned into one pitch-class histogram per measure as the
+# file streams in; the key tracker then slides a window of KEY_WINDOW measures.
+KEY_WINDOW = int(os.environ.get("KEY_WINDOW", 4))
+KEY_HOLD = int(os.environ.get("KEY_HOLD", 2))
+KEY_PC_SHARE = float(os.environ.get("KEY_PC_SHARE", 0.05))
+PERCUSSION_CHANNEL = 9
+
+class ScoreError(ValueError):
+    pass
+
+def histogram_keys(hist, total, k=3):
+    """Keys for a pitch-class histogram. Pitch classes under KEY_PC_SHARE of the notes
+    are ignored, so passing chromatic notes don't flatten the key. Keys whose scales
+    fit equally well are ranked by correlation with their key profile (Krumhansl-Schmuckler),
+    so a I-V vamp stays in the key of I rather than going to the key of V."""
+    hist = np.asarray(hist, dtype=float)
+    present = hist >= max(1, total * KEY_PC_SHARE)
+    size = int(present.sum())
+    if not size:
+        return []
+    fits = TONAL_DEGREES @ present
+    order = np.lexsort((-(TONAL_PROFILES @ hist), -fits))[:k]
+    return [(NOTE_LIST[TONAL_MASKS[i][0]], TONAL_MASKS[i][1], round(fits[i] / size * 100)) for i in order]
+
+class KeyTracker:
+    """Key of the last `window` measures. Each measure's histogram is added as it
+    enters and subtracted as it leaves, so a step costs O(12) however long the piece."""
+    def __init__(self, window=KEY_WINDOW, hold=KEY_HOLD):
+        self.size, self.hold = window, hold
+        self.window = deque()
+        self.hist = [0] * 12
+        self.total = 0
+        self.key = None
+        self.pending = None  # [candidate, measure it first appeared in, measures held]
+        self.changes = []
+
+    def push(self, measure, counts):
+        self.window.append(counts)
+        for pc, c in enumerate(counts):
+            self.hist[pc] += c
+        self.total += sum(counts)
+        if len(self.window) > self.size:
+            old = self.window.popleft()
+            for pc, c in enumerate(old):
+                self.hist[pc] -= c
+            self.total -= sum(old)
+        self._update(measure)
+
+    def current(self):
+        if self.total < 3:
+            return None
+        ranked = histogram_keys(self.hist, self.total, 1)
+        return ranked[0] if ranked else None
+
+    def _update(self, measure):
+        candidate = self.current()
+        if candidate is None or self.key and candidate[:2] == self.key[:2]:
+            self.pending = None
+            return
+        if self.key is None:
+            self._change(measure, candidate)
+        elif self.pending and self.pending[0][:2] == candidate[:2]:
+            self.pending[2] += 1
+        else:
+            self.pending = [candidate, measure, 1]
+        if self.pending and self.pending[2] >= self.hold:
+            self._change(self.pending[1], self.pending[0])
+
+    def _change(self, measure, candidate):
+        self.key, self.pending = candidate, None
+        self.changes.append(KeyChange(measure, *candidate))
+
+class ScoreBuilder:
+    """Per-measure pitch-class counts plus the running totals of a score."""
+    def __init__(self, source):
+        self.source = source
+        self.measures = []
+        self.labels = []
+        self.parts = 0
+        self.notes = 0
+        self.lowest, self.highest = 128, -1
+
+    def _grow(self, measure):
+        while len(self.measures) <= measure:
+            self.measures.append([0] * 12)
+            self.labels.append(str(len(self.labels) + 1))
+
+    def note(self, measure, midi):
+        self._grow(measure)
+        self.measures[measure][midi % 12] += 1
+        self.notes += 1
+        self.lowest, self.highest = min(self.lowest, midi), max(self.highest, midi)
+
+    def label(self, measure, label):
+        self._grow(measure)
+        self.labels[measure] = label
+
+    def finish(self, window):
+        if not self.notes:
+            raise ScoreError("no pitched notes found")
+        tracker = KeyTracker(window)
+        totals = [0] * 12
+        for label, counts in zip(self.labels, self.measures):
+            tracker.push(label, counts)
+            for pc, c in enumerate(counts):
+                totals[pc] += c
+        info = ScoreInfo(self.source, self.parts, len(self.measures), self.notes, MIDI_NAMES[self.lowest], MIDI_NAMES[self.highest], window, tracker.changes)
+        keys = histogram_keys(totals, self.notes)
+        return info, keys
+
+def _vlq(buf, pos):
+    value = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value = value << 7 | byte & 0x7F
+        if byte < 0x80:
+            return value, pos
+
+class SmfReader:
+    """Incremental Standard MIDI File parser: bytes in, (measure, note) pairs out.
+
+    Only the unparsed tail of the stream is buffered. Measures follow the time
+    signatures, which sit in the first track of format 1 files; drums on
+    channel 10 are skipped as unpitched."""
+    def __init__(self, builder):
+        self.builder = builder
+        self.buf = bytearray()
+        self.division = None
+        self.track_left = 0
+        self.skip = 0
+        self.tick = 0
+        self.running = None
+        self.signatures = [(0, 0, None)]  # (tick, first measure, ticks per measure)
+
+    def feed(self, chunk):
+        self.buf += chunk
+        pos = 0
+        try:
+            while True:
+                if self.skip:
+                    n = min(self.skip, len(self.buf) - pos)
+                    pos += n
+                    self.skip -= n
+                    if self.skip:
+                        break
+                if self.track_left > 0:
+                    pos = self._event(pos)
+                    continue
+                if self.division is None:
+                    if len(self.buf) - pos < 14:
+                        break
+                    if self.buf[pos:pos + 4] != b"MThd":
+                        raise ScoreError("not a Standard MIDI File")
+                    size = int.from_bytes(self.buf[pos + 4:pos + 8], "big")
+                    division = int.from_bytes(self.buf[pos + 12:pos + 14], "big")
+                    if division & 0x8000:
+                        raise ScoreError("SMPTE time division is not supported")
+                    self.division = division
+                    self.signatures = [(0, 0, division * 4)]
+                    pos += 8
+                    self.skip = size - 6
+                    pos += 6
+                    continue
+                if len(self.buf) - pos < 8:
+                    break
+                kind, size = bytes(self.buf[pos:pos + 4]), int.from_bytes(self.buf[pos + 4:pos + 8], "big")
+                pos += 8
+                if kind == b"MTrk":
+                    self.track_left, self.tick, self.running = size, 0, None
+                    self.builder.parts += 1
+                else:
+                    self.skip = size
+        except IndexError:
+            pass  # event split across chunks; resume from its first byte
+        del self.buf[:pos]
+
+    def _event(self, pos):
+        start = pos
+        delta, pos = _vlq(self.buf, pos)
+        status = self.buf[pos]
+        if status >= 0x80:
+            pos += 1
+            if status < 0xF0:
+                self.running = status
+        elif self.running is None:
+            raise ScoreError("MIDI data byte without a status byte")
+        else:
+            status = self.running
+        if status == 0xFF:
+            kind = self.buf[pos]
+            length, pos = _vlq(self.buf, pos + 1)
+            if pos + length > len(self.buf):
+                raise IndexError
+            if kind == 0x58 and length >= 2:
+                self._signature(self.tick + delta, self.buf[pos], self.buf[pos + 1])
+            pos += length
+        elif status in (0xF0, 0xF7):
+            length, pos = _vlq(self.buf, pos)
+            if pos + length > len(self.buf):
+                raise IndexError
+            pos += length
+            self.running = None
+        else:
+            size = 1 if status & 0xF0 in (0xC0, 0xD0) else 2
+            if pos + size > len(self.buf):
+                raise IndexError
+            if status & 0xF0 == 0x90 and self.buf[pos + 1] and status & 0x0F != PERCUSSION_CHANNEL:
+                self.builder.note(self._measure(self.tick + delta), self.buf[pos])
+            pos += size
+        self.tick += delta
+        self.track_left -= pos - start
+        return pos
+
+    def _measure(self, tick):
+        sig_tick, first, length = self.signatures[bisect.bisect_right(self.signatures, (tick, math.inf)) - 1]
+        return first + (tick - sig_tick) // length
+
+    def _signature(self, tick, numerator, denominator_power):
+        if self.signatures[-1][0] > tick or not numerator:
+            return  # a later track restating the meter; the first track's map stands
+        length = max(1, self.division * 4 * numerator >> denominator_power)
+        sig_tick, first, old = self.signatures[-1]
+        bars = -(-(tick - sig_tick) // old)
+        if sig_tick == tick:
+            self.signatures[-1] = (tick, first, length)
+        else:
+            self.signatures.append((tick, first + bars, length))
+
+class MusicXmlReader:
+    """Pull-parses MusicXML measure by measure, discarding each measure once read."""
+    def __init__(self, builder):
+        self.builder = builder
+        self.parser = ET.XMLPullParser(("start", "end"))
+        self.root = self.part = None
+        self.first_part = True
+        self.measure = -1
+
+    def feed(self, chunk):
+        try:
+            self.parser.feed(chunk)
+            self._drain()
+        except ET.ParseError as e:
+            raise ScoreError(f"invalid MusicXML: {e}") from None
+
+    def close(self):
+        try:
+            self.parser.close()
+            self._drain()
+        except ET.ParseError as e:
+            raise ScoreError(f"invalid MusicXML: {e}") from None
+        if self.root is None or self.root.tag not in ("score-partwise", "score-timewise"):
+            raise ScoreError("expected a score-partwise or score-timewise MusicXML document")
+
+    def _drain(self):
+        for event, elem in self.parser.read_events():
+            tag = elem.tag
+            if event == "start":
+                if self.root is None:
+                    self.root = elem
+                elif tag == "part" and self.root.tag == "score-partwise":
+                    # Parts follow one another; measure numbering restarts with each.
+                    self.first_part = self.part is None
+                    self.part, self.measure = elem, -1
+                elif tag == "measure":
+                    self.measure += 1
+                    if self.first_part:
+                        self.builder.label(self.measure, elem.get("number") or str(self.measure + 1))
+            elif tag == "score-part":
+                self.builder.parts += 1
+            elif tag == "note":
+                m = self._pitch(elem)
+                if m is not None:
+                    self.builder.note(max(self.measure, 0), m)
+                elem.clear()
+            elif tag == "measure":
+                (self.part if self.part is not None else self.root).remove(elem)
+
+    @staticmethod
+    def _pitch(note):
+        # Rests and unpitched notes have no <pitch>; a tie stop continues an earlier note.
+        pitch = note.find("pitch")
+        if pitch is None or any(t.get("type") == "stop" for t in note.iterfind("tie")):
+            return None
+        step, octave = pitch.findtext("step"), pitch.findtext("octave") or ""
+        try:
+            m = (int(octave) + 1) * 12 + NOTE_INDEX[step] + round(float(pitch.findtext("alter") or 0))
+        except (KeyError, ValueError):
+            return None
+        return m if 0 <= m < 128 else None
+
+SCORE_PREAMBLE = b"\xef\xbb\xbf \t\r\n"  # BOM and whitespace allowed before the first byte that identifies the format
+
+def score_reader(head):
+    """Reader for an upload that starts with `head` (BOM and leading whitespace stripped)."""
+    if head[:4] == b"MThd":
+        return SmfReader(ScoreBuilder("midi"))
+    if head[:2] == b"PK":
+        raise ScoreError("compressed .mxl is not supported; upload the uncompressed .musicxml")
+    if head[:1] == b"<":
+        return MusicXmlReader(ScoreBuilder("musicxml"))
+    raise ScoreError("expected a Standard MIDI File or a MusicXML document")
+
+async def analyze_score(chunks, window=KEY_WINDOW):
+    """Stream a MIDI or MusicXML score into per-measure histograms, then track its key."""
+    reader = None
+    buffered = b""  # the start of the upload, held until its format can be told
+    async for chunk in chunks:
+        if reader is None:
+            buffered += chunk
+            head = buffered.lstrip(SCORE_PREAMBLE)
+            if len(head) < 4:
+                continue
+            reader = score_reader(head)
+            chunk, buffered = buffered, b""
+        reader.feed(chunk)
+    if reader is None:
+        if not buffered.lstrip(SCORE_PREAMBLE):
+            raise ScoreError("empty upload")
+        reader = score_reader(buffered.lstrip(SCORE_PREAMBLE))
+        reader.feed(buffered)
+    if isinstance(reader, MusicXmlReader):
+        reader.close()
+    elif reader.track_left > 0 or reader.skip or reader.division is None:
+        raise ScoreError("truncated MIDI file")
+    clock = StageClock()
+    info, keys = reader.builder.finish(max(1, window))
+    clock.lap("score")
+    a = Analysis(excerpt=f"score: {info.source}, {info.measures} measures, {info.notes} notes", score=info)
+    a.keys = [KeyCandidate(*k) for k in keys]
+    a.range_hz = round(float(MIDI_FREQS[reader.builder.highest] - MIDI_FREQS[reader.builder.lowest]), 2)
+    return a
 
 class Req(BaseModel):
     data: str = ""
+    fresh: bool = False
 
-async def try_ai(data):
-    if not data or not data.strip():
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 8))
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", 0.95))
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", 2.0))
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", 3))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", 30))
+
+class Breaker:
+    """Per-provider circuit breaker: opens after `threshold` failures within a cooldown
+    of each other, or a 429. Once the cooldown passes it is half-open: the first
+    `allow` admits one probe and holds everyone else off until the probe is
+    recorded (or another cooldown passes, if it never is)."""
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold, self.cooldown = threshold, cooldown
+        self.failures, self.last_failure, self.open_until = 0, 0.0, 0.0
+        self.tripped = False
+
+    def ready(self):
+        """Whether a call could go through now, without claiming the probe."""
+        return time.monotonic() >= self.open_until
+
+    def allow(self):
+        now = time.monotonic()
+        if now < self.open_until:
+            return False
+        if self.tripped:
+            self.open_until = now + self.cooldown
+        return True
+
+    def record(self, ok, retry_after=None):
+        now = time.monotonic()
+        if ok:
+            self.failures, self.open_until, self.tripped = 0, 0.0, False
+            return
+        if now - self.last_failure > self.cooldown:
+            self.failures = 0
+        self.failures += 1
+        self.last_failure = now
+        if self.tripped or retry_after is not None or self.failures >= self.threshold:
+            self.open_until = now + (retry_after if retry_after is not None else self.cooldown)
+            self.tripped = True
+
+class Provider:
+    def __init__(self, name, env, url, payload, extract, streams=False):
+        self.name, self.env = name, env
+        self.url = os.environ.get(f"{name.upper()}_API_URL", url)
+        self.payload, self.extract, self.streams = payload, extract, streams
+        self.breaker = Breaker()
+        self.latencies = deque(maxlen=64)
+
+    @property
+    def key(self):
+        return os.environ.get(self.env)
+
+    def hedge_delay(self):
+        if len(self.latencies) < 8:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE))]
+
+PROVIDERS = [
+    Provider("groq", "GROQ_API_KEY", "https://api.groq.com/openai/v1/chat/completions",
+             lambda prompt: {"model": "llama-3.3-70b-versatile", "messages": [{"role": "user", "content": prompt}], "max_tokens": 700, "temperature": 0.7},
+             lambda j: j["choices"][0]["message"]["content"], streams=True),
+    Provider("openrouter", "OPENROUTER_API_KEY", "https://openrouter.ai/api/v1/chat/completions",
+             lambda prompt: {"model": "meta-llama/llama-3.3-70b-instruct:free", "messages": [{"role": "user", "content": prompt}], "max_tokens": 700},
+             lambda j: j["choices"][0]["message"]["content"], streams=True),
+    Provider("huggingface", "HUGGINGFACE_API_KEY", "https://api-inference.huggingface.co/models/mistralai/Mistral-7B-Instruct-v0.3",
+             lambda prompt: {"inputs": prompt, "parameters": {"max_new_tokens": 400}},
+             lambda j: j[0]["generated_text"]),
+]
+
+def remaining_time(deadline):
+    """Seconds left before `deadline`, capped at LLM_TIMEOUT; LLM_TIMEOUT without one."""
+    return LLM_TIMEOUT if deadline is None else min(LLM_TIMEOUT, deadline - time.monotonic())
+
+class StreamTruncated(Exception):
+    """A provider stream stopped after text was yielded, before its end."""
+
+def retry_after(r):
+    try:
+        return float(r.headers.get("retry-after", ""))
+    except ValueError:
+        return None
+
+class ProviderRouter:
+    """Routes prompts over PROVIDERS in priority order on one pooled client.
+
+    The next provider is hedged in once the latest request outlives that
+    provider's latency percentile, or straight away once every running request
+    has failed; the first answer wins and the rest are cancelled. Providers with
+    an open breaker are skipped without a network round trip.
+    """
+    def __init__(self, providers):
+        self.providers = providers
+        self.client = None
+
+    async def open(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(http2=True, timeout=LLM_TIMEOUT, limits=httpx.Limits(max_connections=64, max_keepalive_connections=16, keepalive_expiry=120))
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def available(self):
+        ready = []
+        for p in self.providers:
+            if not p.key:
+                continue
+            if p.breaker.ready():
+                ready.append(p)
+            else:
+                PROVIDER_SKIPPED.inc(p.name)
+        return ready
+
+    async def call(self, provider, prompt, timeout=LLM_TIMEOUT):
+        if not provider.breaker.allow():  # another request holds the half-open probe
+            PROVIDER_SKIPPED.inc(provider.name)
+            return None
+        start = time.monotonic()
+        outcome = "exception"
+        try:
+            r = await self.client.post(provider.url, headers={"Authorization": f"Bearer {provider.key}"}, json=provider.payload(prompt), timeout=timeout)
+            if r.status_code == 200:
+                text = provider.extract(r.json())
+                outcome = "success"
+                provider.latencies.append(time.monotonic() - start)
+                provider.breaker.record(True)
+                return text
+            outcome = "non-200"
+            log.warning("%s returned HTTP %s", provider.name, r.status_code)
+            provider.breaker.record(False, (retry_after(r) or BREAKER_COOLDOWN) if r.status_code == 429 else None)
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except httpx.TimeoutException:
+            outcome = "timeout"
+            log.warning("%s timed out after %.1fs", provider.name, time.monotonic() - start)
+            provider.breaker.record(False)
+        except Exception as e:
+            log.warning("%s call failed: %r", provider.name, e)
+            provider.breaker.record(False)
+        finally:
+            PROVIDER_SECONDS.observe(time.monotonic() - start, provider.name, outcome)
         return None
-    prompt = f"""You are Symphony Conductor AI — an expert orchestra conductor analyzing live performance.
+
+    async def complete(self, prompt, deadline=None):
+        """First answer from the providers, or None. With a `deadline`
+        (time.monotonic() value) every call and hedge fits inside it."""
+        queue = deque(self.available())
+        if not queue:
+            return None
+        await self.open()
+        pending = set()
+        last = None
+        try:
+            while queue or pending:
+                remaining = remaining_time(deadline)
+                if remaining <= 0:
+                    return None
+                if not pending:
+                    last = queue.popleft()
+                    pending.add(asyncio.ensure_future(self.call(last, prompt, remaining)))
+                timeout = min(last.hedge_delay(), remaining) if queue else remaining
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if queue and remaining_time(deadline) > 0:
+                        last = queue.popleft()
+                        pending.add(asyncio.ensure_future(self.call(last, prompt, remaining_time(deadline))))
+                    continue
+                for t in done:
+                    if t.result():
+                        return t.result()
+            return None
+        finally:
+            for t in pending:
+                t.cancel()
+
+    async def stream(self, prompt, deadline=None):
+        """Yield the first available provider's answer as it is generated.
+
+        Providers are tried in order until one starts answering; once text has
+        been yielded there is no fallback, and if the stream then fails or hits
+        the deadline before [DONE] or EOF, StreamTruncated is raised. Providers
+        without a streaming API yield their whole answer as one chunk. httpx
+        timeouts apply per read, so each read is also bounded by what is left
+        of `deadline`.
+        """
+        for provider in self.available():
+            timeout = remaining_time(deadline)
+            if timeout <= 0:
+                return
+            await self.open()
+            if not provider.streams:
+                try:
+                    async with asyncio.timeout(timeout):
+                        text = await self.call(provider, prompt, timeout)
+                except TimeoutError:
+                    return
+                if text:
+                    yield text
+                    return
+                continue
+            if not provider.breaker.allow():
+                PROVIDER_SKIPPED.inc(provider.name)
+                continue
+            started, outcome, start = False, "cancelled", time.monotonic()
+            try:
+                async with self.client.stream("POST", provider.url, headers={"Authorization": f"Bearer {provider.key}"}, json={**provider.payload(prompt), "stream": True}, timeout=timeout) as r:
+                    if r.status_code != 200:
+                        outcome = "non-200"
+                        log.warning("%s returned HTTP %s", provider.name, r.status_code)
+                        provider.breaker.record(False, (retry_after(r) or BREAKER_COOLDOWN) if r.status_code == 429 else None)
+                        continue
+                    lines = r.aiter_lines()
+                    while True:
+                        # No yield inside the timeout: it must not fire while the caller holds the chunk.
+                        async with asyncio.timeout(remaining_time(deadline)):
+                            line = await anext(lines, None)
+                        if line is None:
+                            break
+                        if not line.startswith("data:"):
+                            continue
+                        payload = line[5:].strip()
+                        if payload == "[DONE]":
+                            break
+                        delta = json.loads(payload)["choices"][0]["delta"].get("content")
+                        if delta:
+                            started = True
+                            yield delta
+                outcome = "success" if started else "exception"
+            except (httpx.TimeoutException, TimeoutError):
+                outcome = "timeout"
+                log.warning("%s stream timed out after %.1fs", provider.name, time.monotonic() - start)
+            except Exception as e:
+                outcome = "exception"
+                log.warning("%s stream failed: %r", provider.name, e)
+            finally:
+                PROVIDER_SECONDS.observe(time.monotonic() - start, provider.name, outcome)
+            if outcome == "success":
+                provider.breaker.record(True)
+                return
+            provider.breaker.record(False)
+            if started:
+                raise StreamTruncated(provider.name)
+
+ROUTER = ProviderRouter(PROVIDERS)
+
+def build_prompt(data):
+    return f"""You are Symphony Conductor AI — an expert orchestra conductor analyzing live performance.
 
 Analyze the following musical input and provide structured, actionable feedback.
 Cover these areas as relevant:
@@ -320,42 +1682,542 @@ Cover these areas as relevant:
 Use section headers with ━━━ formatting. Be concise but thorough. Use music emoji.
 
 Input: {data}"""
-    groq_key = os.environ.get("GROQ_API_KEY")
-    if groq_key:
-        try:
-            async with httpx.AsyncClient(timeout=8) as c:
-                r = await c.post("https://api.groq.com/openai/v1/chat/completions", headers={"Authorization": f"Bearer {groq_key}"}, json={"model": "llama-3.3-70b-versatile", "messages": [{"role": "user", "content": prompt}], "max_tokens": 700, "temperature": 0.7})
-                if r.status_code == 200:
-                    return r.json()["choices"][0]["message"]["content"]
-        except Exception:
-            pass
-    openrouter_key = os.environ.get("OPENROUTER_API_KEY")
-    if openrouter_key:
+
+async def try_ai(data, deadline=None):
+    if not data or not data.strip():
+        return None
+    return await ROUTER.complete(build_prompt(data), deadline)
+
+ADMISSION_CONCURRENCY = int(os.environ.get("ADMISSION_CONCURRENCY", 16))
+ADMISSION_QUEUE = int(os.environ.get("ADMISSION_QUEUE", 64))
+CLIENT_RATE = float(os.environ.get("CLIENT_RATE", 0.5))
+CLIENT_BURST = float(os.environ.get("CLIENT_BURST", 5))
+CLIENT_TABLE_SIZE = 10000
+TRUST_PROXY = os.environ.get("TRUST_PROXY", "").lower() in ("1", "true", "yes")
+REQUEST_BUDGET = float(os.environ.get("REQUEST_BUDGET", 10))
+MIN_LLM_BUDGET = float(os.environ.get("MIN_LLM_BUDGET", 1.5))
+SHED_LATENCY = float(os.environ.get("SHED_LATENCY", 6))
+SHED_PROBE_INTERVAL = float(os.environ.get("SHED_PROBE_INTERVAL", 5))
+
+class Admission:
+    """Gate in front of every upstream LLM call.
+
+    A request is answered locally instead, with the reason as its path, when
+    the wait queue is full, when recent LLM calls have averaged over
+    SHED_LATENCY (one probe is let through every SHED_PROBE_INTERVAL so the
+    average can recover), when its client's token bucket is empty, or when it
+    would reach a slot with less than MIN_LLM_BUDGET left before its deadline.
+    A `client` of None has already been charged (batch items share one token).
+    """
+    def __init__(self, concurrency, queue_size):
+        self.slots = asyncio.Semaphore(concurrency)
+        self.queue_size = queue_size
+        self.waiting = self.inflight = 0
+        self.latency = 0.0  # moving average of admitted call durations
+        self.probed = 0.0
+        self.buckets = OrderedDict()  # client -> [tokens, last refill]
+
+    def take(self, client, now):
+        bucket = self.buckets.pop(client, None) or [CLIENT_BURST, now]
+        bucket[0] = min(CLIENT_BURST, bucket[0] + (now - bucket[1]) * CLIENT_RATE)
+        bucket[1] = now
+        self.buckets[client] = bucket
+        if len(self.buckets) > CLIENT_TABLE_SIZE:
+            self.buckets.popitem(last=False)
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    async def acquire(self, client, deadline):
+        """None once a slot is held (pair with release), else why the call was shed."""
+        now = time.monotonic()
+        if self.slots.locked() and self.waiting >= self.queue_size:
+            return "queue_full"
+        probe = self.latency > SHED_LATENCY
+        if probe and now - self.probed < SHED_PROBE_INTERVAL:
+            return "slow_providers"
+        if client is not None and not self.take(client, now):
+            return "rate_limited"
+        budget = deadline - now - MIN_LLM_BUDGET
+        if budget <= 0:
+            return "deadline"
+        self.waiting += 1
         try:
-            async with httpx.AsyncClient(timeout=8) as c:
-                r = await c.post("https://openrouter.ai/api/v1/chat/completions", headers={"Authorization": f"Bearer {openrouter_key}"}, json={"model": "meta-llama/llama-3.3-70b-instruct:free", "messages": [{"role": "user", "content": prompt}], "max_tokens": 700})
-                if r.status_code == 200:
-                    return r.json()["choices"][0]["message"]["content"]
-        except Exception:
-            pass
-    hf_key = os.environ.get("HUGGINGFACE_API_KEY")
-    if hf_key:
+            async with asyncio.timeout(budget):
+                await self.slots.acquire()
+        except TimeoutError:
+            return "deadline"
+        finally:
+            self.waiting -= 1
+        if probe:
+            self.probed = time.monotonic()
+        self.inflight += 1
+        return None
+
+    def release(self, elapsed):
+        """Free the slot; `elapsed` is the provider latency the shedding average sees."""
+        self.inflight -= 1
+        self.latency += (elapsed - self.latency) * 0.2
+        self.slots.release()
+
+    async def run(self, client, deadline, compute):
+        """(result, path): path is "llm" if compute answered, else why it didn't."""
+        reason = await self.acquire(client, deadline)
+        if reason:
+            return None, reason
+        start = time.monotonic()
         try:
-            async with httpx.AsyncClient(timeout=8) as c:
-                r = await c.post("https://api-inference.huggingface.co/models/mistralai/Mistral-7B-Instruct-v0.3", headers={"Authorization": f"Bearer {hf_key}"}, json={"inputs": prompt, "parameters": {"max_new_tokens": 400}})
-                if r.status_code == 200:
-                    return r.json()[0]["generated_text"]
-        except Exception:
-            pass
-    return None
+            result = await compute()
+        finally:
+            self.release(time.monotonic() - start)
+        return result, "llm" if result else "no_answer"
+
+ADMISSION = Admission(ADMISSION_CONCURRENCY, ADMISSION_QUEUE)
+
+def client_id(request):
+    """Rate-limit key: the peer address, or behind a proxy (TRUST_PROXY) the last
+    X-Forwarded-For entry, which that proxy appended. Earlier entries are
+    written by the caller and can't be trusted."""
+    forwarded = request.headers.get("x-forwarded-for") if TRUST_PROXY else None
+    if forwarded:
+        return forwarded.rsplit(",", 1)[-1].strip()
+    return request.client.host if request.client else "unknown"
+
+def request_deadline(request):
+    """When the answer is due: REQUEST_BUDGET after arrival, or sooner if the caller
+    sent a shorter X-Request-Timeout (seconds)."""
+    budget = REQUEST_BUDGET
+    try:
+        budget = min(budget, float(request.headers.get("x-request-timeout", budget)))
+    except ValueError:
+        pass
+    return request.scope.get("received", time.monotonic()) + budget
+
+async def admitted_ai(data, client, deadline, endpoint, fresh=False):
+    """LLM answer through the cache and admission control: (result or None, path).
+    Cache hits and calls coalesced onto another request's cost no admission."""
+    if not data.strip():
+        return None, "no_input"
+    outcome = {}
+
+    async def compute():
+        result, outcome["path"] = await ADMISSION.run(client, deadline, lambda: try_ai(data, deadline))
+        return result
+
+    result = await LLM_CACHE.fetch(cache_key(data), compute, fresh=fresh)
+    path = outcome.get("path", "cache" if result else "no_answer")
+    if not result and path != "no_answer":
+        SHED_TOTAL.inc(endpoint, path)
+    return result, path
+
+LLM_CACHE_SIZE = int(os.environ.get("LLM_CACHE_SIZE", 256))
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", 600))
+LOCAL_CACHE_SIZE = int(os.environ.get("LOCAL_CACHE_SIZE", 2048))
+LOCAL_CACHE_TTL = float(os.environ.get("LOCAL_CACHE_TTL", 3600))
+
+class ResultCache:
+    """Bounded LRU cache with a per-entry TTL.
+
+    `fetch` coalesces concurrent misses on the same key into a single call of
+    `compute`; `lookup` is the synchronous variant for deterministic results.
+    None is never cached, so failed upstream calls are retried next time.
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize, self.ttl = maxsize, ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = self.misses = self.evictions = self.coalesced = 0
+
+    def get(self, key):
+        item = self.entries.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires < time.monotonic():
+            del self.entries[key]
+            self.evictions += 1
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def lookup(self, key, compute, fresh=False):
+        value = None if fresh else self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = compute()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    async def fetch(self, key, compute, fresh=False):
+        if not fresh:
+            value = self.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            task = self.inflight.get(key)
+            if task is not None:
+                self.coalesced += 1
+                return await asyncio.shield(task)
+        self.misses += 1
+        task = asyncio.ensure_future(compute())
+        if key not in self.inflight:
+            self.inflight[key] = task
+        task.add_done_callback(lambda t: self._settle(key, t))
+        return await asyncio.shield(task)
+
+    def _settle(self, key, task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if not task.cancelled() and task.exception() is None and task.result() is not None:
+            self.set(key, task.result())
+
+    def stats(self):
+        return {"size": len(self.entries), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits, "misses": self.misses, "evictions": self.evictions, "coalesced": self.coalesced}
+
+LLM_CACHE = ResultCache(LLM_CACHE_SIZE, LLM_CACHE_TTL)
+LOCAL_CACHE = ResultCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+ANALYSIS_CACHE = ResultCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+
+def cache_key(data):
+    return " ".join(data.split())
+
+def local_text(data, fresh=False):
+    # Text is cached apart from the Analysis it renders, so /analyze and /solve share the compute.
+    key = cache_key(data)
+    return LOCAL_CACHE.lookup(key, lambda: render_text_timed(ANALYSIS_CACHE.lookup(key, lambda: analyze(data), fresh=fresh)), fresh=fresh)
 
 @app.post("/solve")
-async def solve(req: Req):
+async def solve(req: Req, request: Request):
     data = req.data
-    result = await try_ai(data)
+    result, path = await admitted_ai(data, client_id(request), request_deadline(request), "/solve", req.fresh)
+    source = "ai"
     if not result:
-        result = analyze_local(data)
-    return JSONResponse({"output": result})
+        result, source = local_text(data, req.fresh), "local"
+    SOLVE_TOTAL.inc("/solve", source)
+    return JSONResponse({"output": result, "source": source, "path": path})
+
+@app.post("/analyze")
+async def analyze_endpoint(req: Req, format: str = "json"):
+    render = RENDERERS.get(format)
+    if render is None:
+        return JSONResponse({"detail": f"format must be one of: {', '.join(RENDERERS)}"}, status_code=400)
+    result = render(ANALYSIS_CACHE.lookup(cache_key(req.data), lambda: analyze(req.data), fresh=req.fresh))
+    if format == "json":
+        return Response(result, media_type="application/json")
+    if format == "html":
+        return HTMLResponse(result)
+    return PlainTextResponse(result)
+
+@app.post("/analyze/audio")
+async def analyze_audio_endpoint(request: Request, format: str = "json", rate: int | None = None, channels: int = 1, bits: int = 16):
+    render = RENDERERS.get(format)
+    if render is None:
+        return JSONResponse({"detail": f"format must be one of: {', '.join(RENDERERS)}"}, status_code=400)
+    try:
+        result = render(await analyze_audio(request.stream(), rate, channels, bits))
+    except AudioError as e:
+        return JSONResponse({"detail": str(e)}, status_code=400)
+    if format == "json":
+        return Response(result, media_type="application/json")
+    if format == "html":
+        return HTMLResponse(result)
+    return PlainTextResponse(result)
+
+@app.post("/analyze/score")
+async def analyze_score_endpoint(request: Request, format: str = "json", window: int = KEY_WINDOW):
+    render = RENDERERS.get(format)
+    if render is None:
+        return JSONResponse({"detail": f"format must be one of: {', '.join(RENDERERS)}"}, status_code=400)
+    try:
+        result = render(await analyze_score(request.stream(), window))
+    except ScoreError as e:
+        return JSONResponse({"detail": str(e)}, status_code=400)
+    if format == "json":
+        return Response(result, media_type="application/json")
+    if format == "html":
+        return HTMLResponse(result)
+    return PlainTextResponse(result)
+
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", os.cpu_count() or 1))
+BATCH_WINDOW = int(os.environ.get("BATCH_WINDOW", BATCH_WORKERS * 4))
+BATCH_AI_CONCURRENCY = int(os.environ.get("BATCH_AI_CONCURRENCY", 4))
+POOL = None
+
+class BatchReq(BaseModel):
+    items: list[str] = []
+    ai: bool = False
+
+async def spool(chunks):
+    # The upload is spooled before the response starts: once it streams, the
+    # response owns the receive channel and the request body can't be read.
+    f = tempfile.SpooledTemporaryFile(max_size=1 << 20)
+    async for chunk in chunks:
+        f.write(chunk)
+    f.seek(0)
+    return f
+
+async def ndjson_lines(f):
+    with f:
+        for line in f:
+            if line.strip():
+                yield line
+
+async def iterate(items):
+    for item in items:
+        yield item
+
+def batch_item(line):
+    value = json.loads(line)
+    if isinstance(value, dict):
+        value = value.get("data", "")
+    if not isinstance(value, str):
+        raise ValueError('expected a string or {"data": "..."}')
+    return value
+
+async def batch_results(items, ai, request):
+    """Analyze items in the process pool and yield NDJSON lines in completion order.
+
+    At most BATCH_WINDOW items are in flight, so memory stays flat however long
+    the input is; LLM enrichment is capped at BATCH_AI_CONCURRENCY calls. The
+    batch costs its client one token; if there is none, every item is local.
+    """
+    loop = asyncio.get_running_loop()
+    ai_slots = asyncio.Semaphore(BATCH_AI_CONCURRENCY)
+    shed = ai and not ADMISSION.take(client_id(request), time.monotonic())
+    if shed:
+        SHED_TOTAL.inc("/solve/batch", "rate_limited")
+
+    async def run(index, item):
+        try:
+            data = batch_item(item) if isinstance(item, bytes) else item
+        except ValueError as e:
+            return {"index": index, "error": str(e)}
+        path = "rate_limited" if shed else "off"
+        if ai and not shed:
+            async with ai_slots:
+                # Each item gets its own budget from when it reaches the front.
+                output, path = await admitted_ai(data, None, time.monotonic() + REQUEST_BUDGET, "/solve/batch")
+            if output:
+                SOLVE_TOTAL.inc("/solve/batch", "ai")
+                return {"index": index, "output": output, "source": "ai", "path": path}
+        SOLVE_TOTAL.inc("/solve/batch", "local")
+        return {"index": index, "output": await loop.run_in_executor(POOL, analyze_local, data), "source": "local", "path": path}
+
+    pending = set()
+    index = 0
+    try:
+        async for item in items:
+            if len(pending) >= BATCH_WINDOW:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    yield json.dumps(t.result(), ensure_ascii=False) + "\n"
+            pending.add(asyncio.ensure_future(run(index, item)))
+            index += 1
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                yield json.dumps(t.result(), ensure_ascii=False) + "\n"
+    finally:
+        for t in pending:
+            t.cancel()
+
+@app.post("/solve/batch")
+async def solve_batch(request: Request, ai: bool = False):
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        items = ndjson_lines(await spool(request.stream()))
+    else:
+        try:
+            body = BatchReq.model_validate_json(await request.body())
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
+        items, ai = iterate(body.items), ai or body.ai
+    return StreamingResponse(batch_results(items, ai, request), media_type="application/x-ndjson")
+
+def sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+async def solve_events(data, fresh, client, deadline):
+    key = cache_key(data)
+    yield sse("local", {"output": local_text(data, fresh)})
+    cached = None if fresh else LLM_CACHE.get(key)
+    if cached:
+        LLM_CACHE.hits += 1
+        yield sse("token", {"text": cached})
+        SOLVE_TOTAL.inc("/solve/stream", "ai")
+        yield sse("done", {"source": "ai", "path": "cache"})
+        return
+    LLM_CACHE.misses += 1
+    chunks = []
+    path = await ADMISSION.acquire(client, deadline) if data.strip() else "no_input"
+    if path is None:
+        start = time.monotonic()
+        first_token = None
+        try:
+            async for chunk in ROUTER.stream(build_prompt(data), deadline):
+                if first_token is None:
+                    first_token = time.monotonic() - start
+                chunks.append(chunk)
+                yield sse("token", {"text": chunk})
+            path = "llm" if chunks else "no_answer"
+        except StreamTruncated:
+            path = "truncated"
+        finally:
+            # A long answer streaming steadily isn't a slow provider: shedding
+            # sees the time to first token, not how long the stream ran.
+            ADMISSION.release(time.monotonic() - start if first_token is None else first_token)
+    elif path != "no_input":
+        SHED_TOTAL.inc("/solve/stream", path)
+    if path == "llm":  # a truncated answer is shown but never cached
+        LLM_CACHE.set(key, "".join(chunks))
+    SOLVE_TOTAL.inc("/solve/stream", "ai" if chunks else "local")
+    yield sse("done", {"source": "ai" if chunks else "local", "path": path})
+
+@app.post("/solve/stream")
+async def solve_stream(req: Req, request: Request):
+    return StreamingResponse(solve_events(req.data, req.fresh, client_id(request), request_deadline(request)), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+WS_DEBOUNCE = float(os.environ.get("WS_DEBOUNCE", 1.5))
+WS_MAX_NOTES = int(os.environ.get("WS_MAX_NOTES", 10000))
+WS_PROMPT_NOTES = 64
+
+class PianoSession:
+    """Analysis state of one /ws connection, updated per note delta.
+
+    Pitch-class and per-pitch counts are kept alongside the notes, so every
+    section is recomputed in constant time however long the sequence grows.
+    """
+    def __init__(self):
+        self.notes = array("B")
+        self.hist = [0] * 12
+        self.pitches = [0] * 128
+        self.mask = 0
+        self.lowest, self.highest = 128, -1
+        self.version = 0
+        self.sent = {}
+
+    def append(self, midi):
+        if len(self.notes) + len(midi) > WS_MAX_NOTES:
+            raise ValueError(f"a session holds at most {WS_MAX_NOTES} notes")
+        for m in midi:
+            self.notes.append(m)
+            self.hist[m % 12] += 1
+            self.pitches[m] += 1
+            self.mask |= 1 << m % 12
+            self.lowest, self.highest = min(self.lowest, m), max(self.highest, m)
+
+    def remove(self, count):
+        for _ in range(min(count, len(self.notes))):
+            m = self.notes.pop()
+            self.hist[m % 12] -= 1
+            self.pitches[m] -= 1
+            if not self.hist[m % 12]:
+                self.mask &= ~(1 << m % 12)
+            if not self.pitches[m] and m in (self.lowest, self.highest):
+                present = [p for p in range(128) if self.pitches[p]]
+                self.lowest, self.highest = (present[0], present[-1]) if present else (128, -1)
+
+    def chord(self):
+        """Chord of what is being played now: the last four notes, or the last three
+        when those four don't name a chord."""
+        name = get_chord_name(self.notes[-4:])
+        if len(self.notes) > 3 and name.endswith("(unclassified voicing)"):
+            return get_chord_name(self.notes[-3:])
+        return name
+
+    def apply(self, message):
+        if not isinstance(message, dict):
+            raise ValueError("expected a JSON object")
+        op = message.get("op")
+        if op == "append":
+            notes = message.get("notes", "")
+            self.append(parse_notes(notes if isinstance(notes, str) else " ".join(map(str, notes)), self.notes[-1] if self.notes else None))
+        elif op == "remove":
+            self.remove(int(message.get("count", 1)))
+        elif op == "clear":
+            self.remove(len(self.notes))
+        else:
+            raise ValueError('op must be "append", "remove" or "clear"')
+        self.version += 1
+
+    def sections(self):
+        n = len(self.notes)
+        return {
+            "count": n,
+            "last": MIDI_NAMES[self.notes[-1]] if n else None,
+            "interval": INTERVAL_TABLE.get(self.notes[-2] * 128 + self.notes[-1]) or make_interval(self.notes[-2] * 128 + self.notes[-1]) if n > 1 else None,
+            "chord": self.chord(),
+            "keys": [{"key": k, "scale": sc, "match": m} for k, sc, m in KEY_INDEX[self.mask][:3]] if n >= 3 else [],
+            "range": {"lowest": MIDI_NAMES[self.lowest], "highest": MIDI_NAMES[self.highest], "hz": round(float(MIDI_FREQS[self.highest] - MIDI_FREQS[self.lowest]), 2)} if n else None,
+            "doubled": [NOTE_LIST[pc] for pc in range(12) if self.hist[pc] > 1],
+        }
+
+    def changes(self):
+        """Sections that differ from what the client last received."""
+        current = self.sections()
+        changed = {k: v for k, v in current.items() if k not in self.sent or self.sent[k] != v}
+        self.sent = current
+        return changed
+
+    def prompt_text(self):
+        return " ".join(MIDI_NAMES[m] for m in self.notes[-WS_PROMPT_NOTES:])
+
+async def session_commentary(websocket, session, client):
+    # Debounced: every delta cancels the pending call, so only a pause in playing reaches the LLM.
+    await asyncio.sleep(WS_DEBOUNCE)
+    version, data = session.version, session.prompt_text()
+    if not data:
+        return
+    text, path = await admitted_ai(data, client, time.monotonic() + REQUEST_BUDGET, "/ws")
+    source = "ai" if text else "local"
+    SOLVE_TOTAL.inc("/ws", source)
+    await websocket.send_text(orjson.dumps({"type": "commentary", "version": version, "source": source, "path": path, "output": text or local_text(data)}).decode())
+
+@app.websocket("/ws")
+async def piano_ws(websocket: WebSocket):
+    await websocket.accept()
+    session, client, commentary = PianoSession(), client_id(websocket), None
+    await websocket.send_text(orjson.dumps({"type": "update", "version": 0, "changed": session.changes()}).decode())
+    try:
+        while True:
+            try:
+                session.apply(orjson.loads(await websocket.receive_text()))
+            except (ValueError, TypeError) as e:
+                await websocket.send_text(orjson.dumps({"type": "error", "detail": str(e)}).decode())
+                continue
+            await websocket.send_text(orjson.dumps({"type": "update", "version": session.version, "changed": session.changes()}).decode())
+            if commentary:
+                commentary.cancel()
+            commentary = asyncio.create_task(session_commentary(websocket, session, client))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if commentary:
+            commentary.cancel()
+
+@app.get("/cache")
+async def cache_stats():
+    return JSONResponse({"llm": LLM_CACHE.stats(), "local": LOCAL_CACHE.stats(), "analysis": ANALYSIS_CACHE.stats()})
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/profile/{profile_id}")
+async def profile_report(profile_id: str):
+    if profile_id not in PROFILES:
+        return JSONResponse({"detail": "unknown or expired profile"}, status_code=404)
+    return PlainTextResponse(PROFILES[profile_id])
 
 @app.get("/")
 async def home():
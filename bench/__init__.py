@@ -0,0 +1,28 @@
+import json, os, platform, time
+
+def percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+def summarize(samples_ns, elapsed_s=None):
+    """p50/p95/p99 latency in microseconds plus throughput for a list of per-call timings."""
+    ordered = sorted(samples_ns)
+    total_s = elapsed_s if elapsed_s is not None else sum(ordered) / 1e9
+    return {
+        "count": len(ordered),
+        "p50_us": round(percentile(ordered, 0.50) / 1e3, 2),
+        "p95_us": round(percentile(ordered, 0.95) / 1e3, 2),
+        "p99_us": round(percentile(ordered, 0.99) / 1e3, 2),
+        "ops_per_s": round(len(ordered) / total_s, 1) if total_s else 0.0,
+    }
+
+def write_results(path, kind, results, **meta):
+    doc = {"kind": kind, "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(), "machine": platform.machine(), **meta, "results": results}
+    if path == "-":
+        print(json.dumps(doc, indent=2))
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(doc, f, indent=2)
+    print(f"wrote {path}")
@@ -0,0 +1,64 @@
+"""Compare benchmark results against a stored baseline.
+
+Exits 1 if any latency grew, or any throughput fell, by more than the
+threshold. Cases missing from either file are reported and skipped. Exits 2
+without comparing if the runs differ in kind, corpus (seed, size), load
+settings or Python version, unless --allow-mismatch is given.
+
+    python -m bench.compare bench/baseline/micro.json bench/results/micro.json --threshold 0.15
+"""
+import argparse, json, sys
+
+LOWER_IS_BETTER = ("p50_us", "p95_us", "p99_us")
+HIGHER_IS_BETTER = ("ops_per_s",)
+RUN_FIELDS = ("kind", "seed", "size", "requests", "concurrency", "python")
+
+def mismatched(baseline, current):
+    """Run settings that differ between the two result files, as (field, baseline, current)."""
+    return [(k, baseline.get(k), current.get(k)) for k in RUN_FIELDS if baseline.get(k) != current.get(k)]
+
+def compare(baseline, current, threshold, metrics):
+    regressions, lines = [], []
+    for case in sorted(set(baseline) | set(current)):
+        if case not in baseline or case not in current:
+            lines.append(f"  {case}: only in {'current' if case in current else 'baseline'}")
+            continue
+        for metric in metrics:
+            old, new = baseline[case].get(metric), current[case].get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change > threshold if metric in LOWER_IS_BETTER else -change > threshold
+            lines.append(f"{'!' if worse else ' '} {case} {metric}: {old} -> {new} ({change:+.1%})")
+            if worse:
+                regressions.append((case, metric, change))
+    return regressions, lines
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("baseline")
+    ap.add_argument("current")
+    ap.add_argument("--threshold", type=float, default=0.15, help="allowed relative change, e.g. 0.15 for 15%%")
+    ap.add_argument("--metrics", default=",".join(LOWER_IS_BETTER + HIGHER_IS_BETTER))
+    ap.add_argument("--allow-mismatch", action="store_true", help="compare even if the runs used different settings")
+    args = ap.parse_args()
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    differences = mismatched(baseline, current)
+    for field, old, new in differences:
+        print(f"{'warning' if args.allow_mismatch else 'error'}: {field} differs: baseline {old}, current {new}")
+    if differences and not args.allow_mismatch:
+        print("runs are not comparable; rerun with the baseline's settings or pass --allow-mismatch")
+        sys.exit(2)
+    baseline, current = baseline["results"], current["results"]
+    regressions, lines = compare(baseline, current, args.threshold, args.metrics.split(","))
+    print("\n".join(lines))
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}")
+        sys.exit(1)
+    print(f"\nno regressions beyond {args.threshold:.0%}")
+
+if __name__ == "__main__":
+    main()
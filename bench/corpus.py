@@ -0,0 +1,36 @@
+"""Seeded input corpus shared by the micro and load benchmarks."""
+import random
+from app import NOTE_LIST, TEMPO_MARKS, DYNAMICS, INSTRUMENTS, SENTIMENTS, SCALE_ALIASES
+
+NOTE_LENGTHS = (4, 32, 256, 2048)
+FILLER = ["the", "in", "bar", "again", "please", "from", "letter", "B", "sounds", "a", "bit", "too", "and", "section", "at"]
+
+def note_line(rng, n):
+    return " ".join(rng.choice(NOTE_LIST) + rng.choice(("", "", "4", "5", "3")) for _ in range(n))
+
+def mixed_line(rng):
+    parts = [note_line(rng, rng.randint(2, 6)), rng.choice(list(TEMPO_MARKS)), f"{rng.randint(40, 220)} bpm",
+             rng.choice(list(DYNAMICS)), rng.choice(("crescendo", "diminuendo", "")), *rng.sample(list(INSTRUMENTS), rng.randint(1, 4))]
+    rng.shuffle(parts)
+    return " ".join(p for p in parts if p)
+
+def sentiment_line(rng):
+    words = rng.sample(list(SENTIMENTS), rng.randint(1, 4)) + rng.sample(FILLER, rng.randint(3, 8))
+    rng.shuffle(words)
+    return " ".join(words)
+
+def scale_line(rng):
+    return f"{rng.choice(NOTE_LIST)} {rng.choice(list(SCALE_ALIASES))} scale"
+
+def rehearsal_notes(rng, lines):
+    return "\n".join(rng.choice((mixed_line, sentiment_line))(rng) for _ in range(lines))
+
+def corpus(seed=0, size=100):
+    """Inputs by category; the same seed always yields the same corpus."""
+    rng = random.Random(seed)
+    out = {f"notes_{n}": [note_line(rng, n) for _ in range(max(1, size // max(1, n // 32)))] for n in NOTE_LENGTHS}
+    out["mixed"] = [mixed_line(rng) for _ in range(size)]
+    out["sentiment"] = [sentiment_line(rng) for _ in range(size)]
+    out["scale"] = [scale_line(rng) for _ in range(size)]
+    out["rehearsal"] = [rehearsal_notes(rng, 200) for _ in range(max(1, size // 20))]
+    return out
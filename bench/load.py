@@ -0,0 +1,97 @@
+"""End-to-end load test of /solve against the stub LLM providers.
+
+Starts bench.stub_llm and the app with uvicorn, points the app's providers at
+the stub, and drives /solve with concurrent requests from the seeded corpus.
+
+    python -m bench.load --groq slow --openrouter 429 --out bench/results/load.json
+"""
+import argparse, asyncio, os, random, socket, subprocess, sys, time
+import httpx
+from bench import summarize, write_results
+from bench.corpus import corpus
+from bench.stub_llm import BEHAVIOURS
+
+PROVIDERS = ("groq", "openrouter", "huggingface")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start(target, port, env):
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", target, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"], env={**os.environ, **env})
+
+async def wait_ready(url, proc, timeout=20):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as c:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"{url} exited with {proc.returncode}")
+            try:
+                await c.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+async def drive(base, inputs, requests, concurrency, fresh, timeout):
+    samples, outcomes = [], {}
+    slots = asyncio.Semaphore(concurrency)
+    rng = random.Random(0)
+    async with httpx.AsyncClient(base_url=base, timeout=timeout, limits=httpx.Limits(max_connections=concurrency)) as c:
+        async def one():
+            data = rng.choice(inputs)
+            async with slots:
+                t = time.perf_counter_ns()
+                try:
+                    r = await c.post("/solve", json={"data": data, "fresh": fresh})
+                    outcome = str(r.status_code)
+                except httpx.HTTPError as e:
+                    outcome = type(e).__name__
+                samples.append(time.perf_counter_ns() - t)
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        elapsed = time.perf_counter() - start
+    return {**summarize(samples, elapsed), "outcomes": outcomes}
+
+async def run(args):
+    stub_port, app_port = free_port(), free_port()
+    stub_env = {f"STUB_{p.upper()}": getattr(args, p) for p in PROVIDERS}
+    stub_env.update(STUB_LATENCY=str(args.stub_latency), STUB_SLOW_LATENCY=str(args.slow_latency))
+    # One load generator stands in for many clients, so per-client rate limits are lifted.
+    app_env = {"LLM_TIMEOUT": str(args.llm_timeout), "CLIENT_RATE": "1e9", "CLIENT_BURST": "1e9"}
+    for p in PROVIDERS:
+        app_env[f"{p.upper()}_API_URL"] = f"http://127.0.0.1:{stub_port}/{p}"
+        app_env[f"{p.upper()}_API_KEY"] = "stub"
+    procs = [start("bench.stub_llm:app", stub_port, stub_env), start("app:app", app_port, app_env)]
+    try:
+        await wait_ready(f"http://127.0.0.1:{stub_port}/docs", procs[0])
+        await wait_ready(f"http://127.0.0.1:{app_port}/cache", procs[1])
+        inputs = [x for cat, xs in corpus(args.seed, 50).items() if cat in ("notes_4", "notes_32", "mixed", "sentiment", "scale") for x in xs]
+        return await drive(f"http://127.0.0.1:{app_port}", inputs, args.requests, args.concurrency, not args.cached, args.llm_timeout * 4)
+    finally:
+        for p in procs:
+            p.terminate()
+            p.wait()
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    for p in PROVIDERS:
+        ap.add_argument(f"--{p}", default="ok", choices=BEHAVIOURS, help=f"stub behaviour for {p}")
+    ap.add_argument("--requests", type=int, default=500)
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--stub-latency", type=float, default=0.05)
+    ap.add_argument("--slow-latency", type=float, default=3.0)
+    ap.add_argument("--llm-timeout", type=float, default=8.0)
+    ap.add_argument("--cached", action="store_true", help="let the response cache answer repeats instead of sending fresh=true")
+    ap.add_argument("--out", default="bench/results/load.json", help="JSON output path, or - for stdout")
+    args = ap.parse_args()
+    scenario = "+".join(f"{p}={getattr(args, p)}" for p in PROVIDERS)
+    result = asyncio.run(run(args))
+    print(scenario, result)
+    write_results(args.out, "load", {f"solve[{scenario}]": result}, requests=args.requests, concurrency=args.concurrency, seed=args.seed)
+
+if __name__ == "__main__":
+    main()
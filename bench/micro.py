@@ -0,0 +1,52 @@
+"""Microbenchmarks for the local analysis path.
+
+    python -m bench.micro --out bench/results/micro.json
+"""
+import argparse, gc, time
+import app
+from bench import summarize, write_results
+from bench.corpus import corpus
+
+def measure(fn, inputs, rounds, min_time):
+    samples = []
+    deadline = time.perf_counter() + min_time
+    done = 0
+    while done < rounds or time.perf_counter() < deadline:
+        for x in inputs:
+            t = time.perf_counter_ns()
+            fn(x)
+            samples.append(time.perf_counter_ns() - t)
+        done += 1
+    return summarize(samples)
+
+def run(seed, size, rounds, min_time):
+    inputs = corpus(seed, size)
+    parsed = {cat: [app.parse_notes(x) for x in xs] for cat, xs in inputs.items()}
+    cases = [("parse_notes", app.parse_notes, inputs), ("detect_key", app.detect_key, parsed),
+             ("get_chord_name", app.get_chord_name, parsed), ("analyze_local", app.analyze_local, inputs)]
+    results = {}
+    gc.disable()
+    try:
+        for name, fn, by_cat in cases:
+            for cat, xs in by_cat.items():
+                if by_cat is parsed and not any(xs):
+                    continue
+                results[f"{name}[{cat}]"] = measure(fn, xs, rounds, min_time)
+                print(f"{name}[{cat}]".ljust(36), results[f"{name}[{cat}]"])
+    finally:
+        gc.enable()
+    return results
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--size", type=int, default=100, help="inputs per corpus category")
+    ap.add_argument("--rounds", type=int, default=5, help="minimum passes over each category")
+    ap.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per case")
+    ap.add_argument("--out", default="bench/results/micro.json", help="JSON output path, or - for stdout")
+    args = ap.parse_args()
+    results = run(args.seed, args.size, args.rounds, args.min_time)
+    write_results(args.out, "micro", results, seed=args.seed, size=args.size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Stand-in for the three LLM providers used by try_ai.
+
+Each provider's behaviour is set with STUB_GROQ, STUB_OPENROUTER and
+STUB_HUGGINGFACE: ok, slow, 429, error or timeout. STUB_LATENCY and
+STUB_SLOW_LATENCY set the ok and slow response times in seconds.
+
+    STUB_GROQ=429 uvicorn bench.stub_llm:app --port 9100
+"""
+import asyncio, os
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+app = FastAPI()
+
+LATENCY = float(os.environ.get("STUB_LATENCY", 0.05))
+SLOW_LATENCY = float(os.environ.get("STUB_SLOW_LATENCY", 3.0))
+BEHAVIOURS = ("ok", "slow", "429", "error", "timeout")
+
+def behaviour(provider):
+    mode = os.environ.get(f"STUB_{provider.upper()}", "ok")
+    if mode not in BEHAVIOURS:
+        raise ValueError(f"STUB_{provider.upper()} must be one of {BEHAVIOURS}")
+    return mode
+
+async def respond(provider, body):
+    mode = behaviour(provider)
+    if mode == "429":
+        return JSONResponse({"error": "rate limited"}, status_code=429, headers={"Retry-After": "1"})
+    if mode == "error":
+        return JSONResponse({"error": "upstream error"}, status_code=500)
+    await asyncio.sleep({"ok": LATENCY, "slow": SLOW_LATENCY, "timeout": 3600}[mode])
+    return JSONResponse(body)
+
+@app.post("/groq")
+async def groq():
+    return await respond("groq", {"choices": [{"message": {"content": "groq stub analysis"}}]})
+
+@app.post("/openrouter")
+async def openrouter():
+    return await respond("openrouter", {"choices": [{"message": {"content": "openrouter stub analysis"}}]})
+
+@app.post("/huggingface")
+async def huggingface():
+    return await respond("huggingface", [{"generated_text": "huggingface stub analysis"}])